@@ -1,58 +1,1358 @@
+import sys
 import os
 
+import atexit
+import base64
+import datetime
+import gzip
+import hashlib          # To derive content-addressed cache IDs
+import json             # To produce a canonical form of request parameters for hashing, and as a cache format
+import logging
 import pickle           # To save response data in a simple local cache
 import pprint           # Dump Python data structure showing the response in a readable format
+import queue
+import sqlite3          # Small index of cache entries, used to apply size/age limits
+import tempfile
+import threading
+import time
 
-# The cached response will be in a cache folder, with the cached
-# file name derived from the image file name = NB the current simple scheme doesn't work when different
-# images have the same file name! Also, doesn't clear the cache ever, or put a time limit on entries,
-# so not operationally robust.
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+try :
+    import fcntl        # File locking on Linux/Mac
+except ImportError :
+    fcntl = None
+    import msvcrt       # File locking on Windows
+
+# The cached response will be in a cache folder, with the cached file name derived from an item ID
+# supplied by the caller. Callers can either supply their own ID (e.g. a file name - NB this simple
+# scheme doesn't work when different items have the same file name!) or use a content-addressed ID,
+# derived from a digest of the request payload plus the API name and its parameters, so that identical
+# requests share a cache entry whatever file they came from.
+#
+# By default the cache is never cleared and entries never expire. A CachePolicy can be set (directly or
+# via environment variables) to limit the total size, the number of entries and the age of entries in a
+# cache location. The policy is enforced each time a response is stored, evicting least-recently-used
+# entries first, using a small index of entries held alongside the cached files.
+#
+# Cached data is held by a storage backend. The default backend uses a directory per cache location, with
+# one binary file and one human-readable file per item. Alternatively all the items for a cache location
+# can be held in a single indexed SQLite database file, which is much quicker to list, back up and copy
+# when there are very large numbers of items. Run this module with the 'migrate' command to import an
+# existing directory-based cache into SQLite form.
+#
+# The directory backend can either hold all the files for a cache location in one 'flat' directory, or
+# spread them across a two-level tree of subdirectories named from a hash of the item ID ('sharded'),
+# which keeps directories small enough for file lookups and creation to stay fast with very large
+# numbers of items. The layout of each location is recorded in a file in the location. Run this module
+# with the 'reshard' command to convert an existing cache location from one layout to the other.
+#
+# The human-readable form of each response can be written when the response is stored ('eager'), by a
+# background thread so it doesn't hold up the caller ('background'), or only on request, by running this
+# module with the 'dump' command ('lazy'). Code storing responses in a worker process should call
+# Cacher.flush() before the worker finishes, and Cacher.close() when the worker process exits, as
+# background work and the metrics summary are otherwise only completed at normal exit.
+#
+# Responses are serialised using a selectable format: 'pickle' (the original format, and the default),
+# or JSON or msgpack, optionally compressed with gzip or zstd, e.g. 'json+gzip' or 'msgpack+zstd'. The
+# format is recorded in a small header at the start of each entry, so entries in different formats (and
+# older header-less pickle entries) can all be read whatever format is currently selected for writing.
+# Run this module with the 'bench' command to compare the formats using existing cache entries.
+#
+# Several threads or processes on the same host can safely share a cache location. Cached files are
+# written to a temporary file and then renamed into place, so a reader never sees a partly-written
+# entry. And getOrFetch() uses a lock per item, so that when several callers miss on the same item at
+# once, only one of them calls the service, and the others wait for and use its result.
+#
+# When the full set of items needed for a run is known in advance, findMissing() reports which of them
+# are not yet cached, and prefetch() fills in the missing ones concurrently, using a bounded pool of
+# worker threads and an optional limit on the rate of calls to the service, so that the main run then
+# only has cache hits.
+#
+# Cacher reports what it is doing through the 'Cacher' logger rather than printing to the console, and
+# keeps counts and timings of its activity (hits, misses, bytes read and written, load, store and
+# service call times) in the shared Cacher.stats object. Each event can also be written to a JSON-lines
+# metrics file, named by the RESPONSE_CACHE_METRICS_FILE environment variable, for later analysis.
+#
+# Optionally, an in-memory tier can be enabled, holding recently used responses for all Cacher objects
+# in the process, so that repeat lookups don't need to touch the file system or unpickle anything.
+
+# #####################################################################################################
+
+logger = logging.getLogger('Cacher')
+
+# #####################################################################################################
+
+# Functions for producing content-addressed cache IDs.
+
+digestBlockSize = 1024 * 1024       # Read files in 1MB blocks when computing digests
+
+def readAndDigestFile(filename) :
+    """ Return the contents of a file as bytes, together with its SHA-256 hex digest, computing the
+        digest block-by-block as the file is read so the file only needs to be read once. """
+
+    h = hashlib.sha256()
+    blocks = []
+    with open(filename, 'rb') as f :
+        for block in iter(lambda: f.read(digestBlockSize), b'') :
+            h.update(block)
+            blocks.append(block)
+    return b''.join(blocks), h.hexdigest()
+
+def contentItemID(apiName, payloadDigest, parameters=None) :
+    """ Return a cache item ID derived from the API name, the API parameters (other than the payload) and
+        a digest of the request payload. """
+
+    # Parameters are reduced to a canonical JSON string (sorted keys, no whitespace) so that the same
+    # parameters always produce the same ID.
+    paramString = json.dumps(parameters or {}, sort_keys=True, separators=(',', ':'), default=str)
+    h = hashlib.sha256()
+    for part in (apiName, paramString, payloadDigest) :
+        h.update(part.encode('utf-8'))
+        h.update(b'\0')
+    return '{0}.{1}'.format(apiName, h.hexdigest())
+
+# #####################################################################################################
+
+# Serialisation formats. A format name is an encoding, optionally followed by '+' and a compression
+# method. Entries in formats other than plain pickle start with a header: a marker, then the length of
+# the format name, then the format name itself.
+
+formatHeaderMarker = b'CACHER:'
+
+def encodeSpecialValue(value) :
+    """ Represent values which JSON/msgpack can't hold directly (e.g. datetimes in some boto3 responses) as tagged dicts """
+    if isinstance(value, datetime.datetime) :
+        return { '__datetime__' : value.isoformat() }
+    if isinstance(value, (bytes, bytearray)) :
+        return { '__bytes__' : base64.b64encode(value).decode('ascii') }
+    raise TypeError('Cannot serialise value of type {0}'.format(type(value)))
+
+def decodeSpecialValue(d) :
+    if '__datetime__' in d and len(d) == 1 :
+        return datetime.datetime.fromisoformat(d['__datetime__'])
+    if '__bytes__' in d and len(d) == 1 :
+        return base64.b64decode(d['__bytes__'])
+    return d
+
+def jsonDumps(response) :
+    return json.dumps(response, separators=(',', ':'), ensure_ascii=False, default=encodeSpecialValue).encode('utf-8')
+
+def jsonLoads(data) :
+    return json.loads(data.decode('utf-8'), object_hook=decodeSpecialValue)
+
+def msgpackDumps(response) :
+    import msgpack      # Optional - only needed if the msgpack format is used
+    return msgpack.packb(response, default=encodeSpecialValue, use_bin_type=True)
+
+def msgpackLoads(data) :
+    import msgpack
+    return msgpack.unpackb(data, object_hook=decodeSpecialValue, raw=False)
+
+def zstdCompress(data) :
+    import zstandard    # Optional - only needed if zstd compression is used
+    return zstandard.ZstdCompressor(level=10).compress(data)
+
+def zstdDecompress(data) :
+    import zstandard
+    return zstandard.ZstdDecompressor().decompress(data)
+
+encodings = {
+    'pickle'    : (pickle.dumps, pickle.loads),
+    'json'      : (jsonDumps, jsonLoads),
+    'msgpack'   : (msgpackDumps, msgpackLoads)
+}
+
+compressions = {
+    'gzip'      : (lambda data : gzip.compress(data, compresslevel=6), gzip.decompress),
+    'zstd'      : (zstdCompress, zstdDecompress)
+}
+
+def checkFormatName(formatName) :
+    encodingName, _, compressionName = formatName.partition('+')
+    if encodingName not in encodings or (compressionName != '' and compressionName not in compressions) :
+        raise ValueError('Unknown cache format {0}'.format(formatName))
+
+def serialiseResponse(response, formatName) :
+    """ Return the response as bytes in the named format, with a header recording the format """
+
+    encodingName, _, compressionName = formatName.partition('+')
+    data = encodings[encodingName][0](response)
+    if compressionName != '' :
+        data = compressions[compressionName][0](data)
+
+    # Plain pickle entries are written without a header, as they always have been, so that they can
+    # still be read by older code.
+    if formatName == 'pickle' :
+        return data
+    nameBytes = formatName.encode('ascii')
+    return formatHeaderMarker + bytes([len(nameBytes)]) + nameBytes + data
+
+def deserialiseResponse(data) :
+    """ Return the response held in bytes produced by serialiseResponse() (or by older versions of Cacher) """
+
+    if not data.startswith(formatHeaderMarker) :
+        return pickle.loads(data)
+
+    nameStart = len(formatHeaderMarker) + 1
+    nameEnd = nameStart + data[len(formatHeaderMarker)]
+    formatName = data[nameStart:nameEnd].decode('ascii')
+    encodingName, _, compressionName = formatName.partition('+')
+    data = data[nameEnd:]
+    if compressionName != '' :
+        data = compressions[compressionName][1](data)
+    return encodings[encodingName][1](data)
+
+# #####################################################################################################
+
+# Storage backends. Each backend object holds the binary data for the items in one cache location, and
+# provides the same small set of methods, so Cacher doesn't need to know how the data is stored.
+
+# Temporary files are created readable only by their owner, so files written via a temporary file are given
+# the permissions a file opened in the usual way would have (normally 0644), so that a cache location can be
+# shared between accounts. The umask can only be read by setting it, so this is done once, on import.
+def getUmask() :
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+newFileMode = 0o666 & ~getUmask()
+
+class DirectoryBackend :
+    """ Holds each item as a file under the cache location directory, with a human-readable version alongside it.
+        The files are either all in the location directory itself ('flat' layout) or in subdirectories two
+        levels down, named from the start of a hash of the item ID ('sharded' layout). """
+
+    name = 'directory'
+
+    # Whether the backend stores a human-readable version of each item alongside it.
+    keepsPrettyDumps = True
+
+    responseSuffix = '.response'
+    prettySuffix = '.response.pretty.txt'
+
+    # The layout used by a location is recorded in a file in the location. New locations use the layout
+    # specified in the environment, if present, otherwise the flat layout.
+    layoutFileName = 'cache.layout'
+    layouts = ('flat', 'sharded')
+    layoutEnvVarName = 'RESPONSE_CACHE_LAYOUT'
+    defaultLayout = os.environ.get(layoutEnvVarName, 'flat')
+
+    def __init__(self, cacheLocation) :
+        self.cacheLocation = cacheLocation
+        # Where the index used to apply cache policy limits is kept.
+        self.indexFile = os.path.join(cacheLocation, 'cache.index.sqlite')
+        self.layoutFile = os.path.join(cacheLocation, self.layoutFileName)
+        self.layoutRecorded = False
+        self.layout = self.readLayout()
+
+    def readLayout(self) :
+        """ Return the layout recorded for the location. A location with no recorded layout is treated as flat if
+            it already holds items (it was created before layouts were recorded), otherwise the default is used. """
+        try :
+            with open(self.layoutFile, 'r') as f :
+                self.layoutRecorded = True
+                return f.read().strip()
+        except FileNotFoundError :
+            pass
+        if os.path.isdir(self.cacheLocation) :
+            with os.scandir(self.cacheLocation) as it :
+                if any(entry.name.endswith(self.responseSuffix) for entry in it) :
+                    return 'flat'
+        return self.defaultLayout
+
+    def recordLayout(self) :
+        """ Make sure the location exists and has a record of its layout """
+        if not os.path.isdir(self.cacheLocation) :
+            os.makedirs(self.cacheLocation, exist_ok=True)
+            logger.info('Created cache location %s', self.cacheLocation)
+        if not os.path.isfile(self.layoutFile) :
+            self.writeAtomically(self.layoutFile, self.layout.encode('ascii'))
+        self.layoutRecorded = True
+
+    def itemDirectory(self, itemID, layout=None) :
+        if (layout or self.layout) == 'flat' :
+            return self.cacheLocation
+        shard = hashlib.sha256(itemID.encode('utf-8')).hexdigest()
+        return os.path.join(self.cacheLocation, shard[0:2], shard[2:4])
+
+    def itemFile(self, itemID) :
+        return os.path.join(self.itemDirectory(itemID), itemID + self.responseSuffix)
+
+    def prettyItemFile(self, itemID) :
+        return os.path.join(self.itemDirectory(itemID), itemID + self.prettySuffix)
+
+    def describe(self, itemID) :
+        return 'cache file {0}'.format(self.itemFile(itemID))
+
+    def read(self, itemID) :
+        """ Return the item's data as bytes, or None if the item is not present """
+        try :
+            with open(self.itemFile(itemID), 'rb') as f :
+                return f.read()
+        except FileNotFoundError :
+            return None
+
+    def contains(self, itemID) :
+        return os.path.isfile(self.itemFile(itemID))
+
+    def write(self, itemID, data, created=None) :
+        """ Store the item's data, returning the number of bytes written """
+        if not self.layoutRecorded :
+            self.recordLayout()
+
+        try :
+            self.writeAtomically(self.itemFile(itemID), data, created)
+        except FileNotFoundError :
+            # Shard directory not created yet.
+            os.makedirs(self.itemDirectory(itemID), exist_ok=True)
+            self.writeAtomically(self.itemFile(itemID), data, created)
+        return len(data)
+
+    def writePretty(self, itemID, text) :
+        """ Store a human-readable version of the item, returning the number of bytes written """
+        if not os.path.isfile(self.itemFile(itemID)) :
+            return 0        # Item removed (e.g. evicted) before a background dump got to it
+        data = text.encode('utf-8')
+        self.writeAtomically(self.prettyItemFile(itemID), data)
+        return len(data)
+
+    def writeAtomically(self, fileName, data, created=None) :
+        """ Write the data to a temporary file in the same directory and then rename it to the target file name,
+            so that anyone reading the file sees either the old or the new contents in full, never part. """
+        fd, tempFileName = tempfile.mkstemp(dir=os.path.dirname(fileName), prefix='.' + os.path.basename(fileName), suffix='.tmp')
+        try :
+            with os.fdopen(fd, 'wb') as f :
+                f.write(data)
+            os.chmod(tempFileName, newFileMode)
+            if created != None :
+                os.utime(tempFileName, (created, created))
+            os.replace(tempFileName, fileName)
+        except BaseException :
+            os.remove(tempFileName)
+            raise
+
+    def createdTime(self, itemID) :
+        return os.path.getmtime(self.itemFile(itemID))
+
+    def delete(self, itemIDs) :
+        for itemID in itemIDs :
+            for fileName in (self.itemFile(itemID), self.prettyItemFile(itemID)) :
+                try :
+                    os.remove(fileName)
+                except FileNotFoundError :
+                    pass
+
+    def itemDirectories(self, layout) :
+        """ Generate the directories which hold items in the specified layout """
+        if layout == 'flat' :
+            yield self.cacheLocation
+            return
+        for level1 in sorted(os.listdir(self.cacheLocation)) :
+            if len(level1) == 2 and os.path.isdir(os.path.join(self.cacheLocation, level1)) :
+                for level2 in sorted(os.listdir(os.path.join(self.cacheLocation, level1))) :
+                    yield os.path.join(self.cacheLocation, level1, level2)
+
+    def itemIDsIn(self, directory) :
+        for fileName in os.listdir(directory) :
+            if fileName.endswith(self.responseSuffix) :
+                yield fileName[:-len(self.responseSuffix)]
+
+    def entries(self) :
+        """ Generate (itemID, size, created) for each item present - NB this looks at every file """
+        if not os.path.isdir(self.cacheLocation) :
+            return
+        for directory in self.itemDirectories(self.layout) :
+            for itemID in self.itemIDsIn(directory) :
+                st = os.stat(self.itemFile(itemID))
+                prettyFile = self.prettyItemFile(itemID)
+                size = st.st_size + (os.path.getsize(prettyFile) if os.path.isfile(prettyFile) else 0)
+                yield itemID, size, st.st_mtime
+
+    def reshard(self, newLayout) :
+        """ Move all the items in the location into their positions in the new layout, and record the new layout.
+            Should only be run while nothing else is using the location. If interrupted, it can be run again
+            to finish the job. Returns the number of items moved. """
+
+        if newLayout not in self.layouts :
+            raise ValueError('Unknown layout {0}, expected one of {1}'.format(newLayout, self.layouts))
+
+        movedCount = 0
+        for oldLayout in self.layouts :
+            if oldLayout == newLayout :
+                continue
+            for directory in list(self.itemDirectories(oldLayout)) :
+                for itemID in list(self.itemIDsIn(directory)) :
+                    targetDirectory = self.itemDirectory(itemID, newLayout)
+                    os.makedirs(targetDirectory, exist_ok=True)
+                    for suffix in (self.responseSuffix, self.prettySuffix) :
+                        if os.path.isfile(os.path.join(directory, itemID + suffix)) :
+                            os.replace(os.path.join(directory, itemID + suffix), os.path.join(targetDirectory, itemID + suffix))
+                    movedCount += 1
+                # Tidy up shard directories left empty by moving to the flat layout.
+                if directory != self.cacheLocation and len(os.listdir(directory)) == 0 :
+                    os.rmdir(directory)
+                    if len(os.listdir(os.path.dirname(directory))) == 0 :
+                        os.rmdir(os.path.dirname(directory))
+
+        self.layout = newLayout
+        self.writeAtomically(self.layoutFile, newLayout.encode('ascii'))
+        self.layoutRecorded = True
+        return movedCount
+
+class SQLiteBackend :
+    """ Holds all the items for the cache location in a single SQLite database file, indexed on item ID. The
+        human-readable version of each item is not stored. """
+
+    name = 'sqlite'
+
+    # Human-readable versions of items are not stored, so there is no point formatting them.
+    keepsPrettyDumps = False
+
+    dbFileName = 'responses.sqlite'
+
+    def __init__(self, cacheLocation) :
+        self.cacheLocation = cacheLocation
+        self.dbFile = os.path.join(cacheLocation, self.dbFileName)
+        # The index used to apply cache policy limits is kept as another table in the same database.
+        self.indexFile = self.dbFile
+        self.lock = threading.Lock()
+
+        os.makedirs(cacheLocation, exist_ok=True)
+        self.conn = sqlite3.connect(self.dbFile, timeout=30, check_same_thread=False)
+        with self.conn :
+            self.conn.execute('CREATE TABLE IF NOT EXISTS responses (itemID TEXT PRIMARY KEY, data BLOB, created REAL)')
+
+    def describe(self, itemID) :
+        return 'cache entry {0} in {1}'.format(itemID, self.dbFile)
+
+    def read(self, itemID) :
+        with self.lock :
+            row = self.conn.execute('SELECT data FROM responses WHERE itemID = ?', (itemID,)).fetchone()
+        return bytes(row[0]) if row != None else None
+
+    def contains(self, itemID) :
+        with self.lock :
+            return self.conn.execute('SELECT 1 FROM responses WHERE itemID = ?', (itemID,)).fetchone() != None
+
+    def write(self, itemID, data, created=None) :
+        with self.lock, self.conn :
+            self.conn.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?)',
+                              (itemID, sqlite3.Binary(data), created if created != None else time.time()))
+        return len(data)
+
+    def writePretty(self, itemID, text) :
+        return 0
+
+    def createdTime(self, itemID) :
+        with self.lock :
+            return self.conn.execute('SELECT created FROM responses WHERE itemID = ?', (itemID,)).fetchone()[0]
+
+    def delete(self, itemIDs) :
+        with self.lock, self.conn :
+            self.conn.executemany('DELETE FROM responses WHERE itemID = ?', [(itemID,) for itemID in itemIDs])
+
+    def entries(self) :
+        with self.lock :
+            rows = self.conn.execute('SELECT itemID, length(data), created FROM responses').fetchall()
+        yield from rows
+
+backendTypes = { backendType.name : backendType for backendType in (DirectoryBackend, SQLiteBackend) }
+
+# Backend objects are shared by all Cacher objects using the same cache location.
+openBackends = {}
+openBackendsLock = threading.Lock()
+
+def openBackend(backendName, cacheLocation) :
+    """ Return the (shared) backend object of the named type for the cache location """
+    with openBackendsLock :
+        backend = openBackends.get((backendName, cacheLocation))
+        if backend == None :
+            backend = backendTypes[backendName](cacheLocation)
+            openBackends[(backendName, cacheLocation)] = backend
+        return backend
+
+# #####################################################################################################
+
+# Cache size and age limits.
+
+class CachePolicy :
+    """ Limits on a cache location, enforced when responses are stored. None means no limit. """
+
+    # Environment variables which can be used to set the default policy
+    maxBytesEnvVarName = 'RESPONSE_CACHE_MAX_BYTES'
+    maxEntriesEnvVarName = 'RESPONSE_CACHE_MAX_ENTRIES'
+    ttlEnvVarName = 'RESPONSE_CACHE_TTL'
+
+    def __init__(self, maxBytes=None, maxEntries=None, ttlSeconds=None) :
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+        self.ttlSeconds = ttlSeconds
+
+    @classmethod
+    def fromEnvironment(cls) :
+        """ Return a policy using limits from the environment variables, if set """
+
+        def envNumber(name, convert) :
+            value = os.environ.get(name)
+            return convert(value) if value else None
+
+        return cls(maxBytes=envNumber(cls.maxBytesEnvVarName, int),
+                   maxEntries=envNumber(cls.maxEntriesEnvVarName, int),
+                   ttlSeconds=envNumber(cls.ttlEnvVarName, float))
+
+    def isBounded(self) :
+        """ Does the policy place any limit on the cache ? """
+        return self.maxBytes != None or self.maxEntries != None or self.ttlSeconds != None
+
+    def isExceeded(self, count, totalBytes) :
+        """ Would a cache with this many entries and bytes be over the policy's size limits ? """
+        return (self.maxEntries != None and count > self.maxEntries) or (self.maxBytes != None and totalBytes > self.maxBytes)
+
+    def __repr__(self) :
+        return 'CachePolicy(maxBytes={0}, maxEntries={1}, ttlSeconds={2})'.format(self.maxBytes, self.maxEntries, self.ttlSeconds)
+
+class CacheStats :
+    """ Counters and timings of cache activity across all Cacher objects in this process. Times are in seconds;
+        'fetches' and 'fetchSeconds' count the calls made to the service on cache misses. """
+
+    counterNames = ['hits', 'memoryHits', 'misses', 'bytesRead', 'loadSeconds',
+                    'stores', 'bytesWritten', 'storeSeconds', 'fetches', 'fetchSeconds',
+                    'evictions', 'expirations', 'bytesEvicted']
+
+    def __init__(self) :
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) :
+        with self.lock :
+            for name in self.counterNames :
+                setattr(self, name, 0)
+
+    def add(self, name, amount=1) :
+        with self.lock :
+            setattr(self, name, getattr(self, name) + amount)
+
+    def asDict(self) :
+        with self.lock :
+            return { name : getattr(self, name) for name in self.counterNames }
+
+    def summary(self) :
+        """ Return a one-line readable summary of the counters """
+        d = self.asDict()
+        lookups = d['hits'] + d['misses']
+        hitRate = 100 * d['hits'] / lookups if lookups > 0 else 0.0
+        return ('Cache: {0} hits ({1} from memory), {2} misses, hit rate {3:.1f}% ; read {4} bytes in {5:.3f}s ; '
+                'stored {6} ({7} bytes) in {8:.3f}s ; {9} service calls took {10:.3f}s ; evicted {11}, expired {12}').format(
+                d['hits'], d['memoryHits'], d['misses'], hitRate, d['bytesRead'], d['loadSeconds'],
+                d['stores'], d['bytesWritten'], d['storeSeconds'], d['fetches'], d['fetchSeconds'], d['evictions'], d['expirations'])
+
+    def __repr__(self) :
+        return 'CacheStats({0})'.format(', '.join('{0}={1}'.format(k, v) for k, v in self.asDict().items()))
+
+class MetricsLog :
+    """ Appends a JSON object per cache event to a file (one per line), for later analysis. A final 'summary' event
+        holding the process's CacheStats counters is written when the process exits. """
+
+    envVarName = 'RESPONSE_CACHE_METRICS_FILE'
+
+    def __init__(self, fileName, stats) :
+        # Line buffered, so each event is a single append, and events from several processes don't get mixed up.
+        self.f = open(fileName, 'a', encoding='utf-8', buffering=1)
+        self.stats = stats
+        self.lock = threading.Lock()
+        atexit.register(self.close)
+
+    @classmethod
+    def fromEnvironment(cls, stats) :
+        fileName = os.environ.get(cls.envVarName)
+        return cls(fileName, stats) if fileName else None
+
+    def record(self, event, **fields) :
+        line = json.dumps(dict(time=time.time(), pid=os.getpid(), event=event, **fields))
+        with self.lock :
+            if self.f != None :
+                self.f.write(line + '\n')
+
+    def close(self) :
+        self.record('summary', **self.stats.asDict())
+        with self.lock :
+            if self.f != None :
+                self.f.close()
+                self.f = None
+
+class CacheIndex :
+    """ Index of the entries in a cache location, recording the size, creation time and last access time of
+        each one, so that limits can be applied without examining every cached file. """
+
+    # The index is a small SQLite database table, in a file chosen by the backend.
+
+    # One index object per backend is shared by all Cacher objects in the process.
+    indexes = {}
+    indexesLock = threading.Lock()
+
+    # Last-access times are only needed to choose entries to evict, so they are held in memory and written
+    # in batches, rather than committing an update on every cache hit. A batch is written once this many
+    # accesses are pending, or this many seconds have passed since the last write, whichever comes first.
+    # Pending accesses are also written before choosing entries to evict, and when the process exits.
+    accessFlushCount = 100
+    accessFlushSeconds = 5.0
+
+    @classmethod
+    def forBackend(cls, backend) :
+        with cls.indexesLock :
+            index = cls.indexes.get(backend.indexFile)
+            if index == None :
+                index = cls(backend)
+                cls.indexes[backend.indexFile] = index
+            return index
+
+    @staticmethod
+    def existsFor(backend) :
+        """ Has an index already been created for the backend ? """
+        if not os.path.isfile(backend.indexFile) :
+            return False
+        conn = sqlite3.connect(backend.indexFile, timeout=30)
+        try :
+            return conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'entries'").fetchone() != None
+        finally :
+            conn.close()
+
+    def __init__(self, backend) :
+        self.backend = backend
+        self.indexFile = backend.indexFile
+        self.lock = threading.Lock()
+        self.pendingAccesses = {}
+        self.lastAccessFlush = time.monotonic()
+
+        isNewIndex = not self.existsFor(backend)
+        os.makedirs(os.path.dirname(self.indexFile), exist_ok=True)
+        self.conn = sqlite3.connect(self.indexFile, timeout=30, check_same_thread=False)
+        with self.conn :
+            self.conn.execute('CREATE TABLE IF NOT EXISTS entries '
+                              '(itemID TEXT PRIMARY KEY, size INTEGER, created REAL, lastAccess REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS entriesByLastAccess ON entries (lastAccess)')
+
+        # If this cache location was in use before the index existed, add the existing entries to the
+        # index. This is the only time we need to look at all the entries.
+        if isNewIndex :
+            self.addExistingEntries()
+
+        atexit.register(self.flushAccessesAtExit)
+
+    def addExistingEntries(self) :
+        rows = [ (itemID, size, created, created) for itemID, size, created in self.backend.entries() ]
+        with self.lock, self.conn :
+            self.conn.executemany('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)', rows)
+
+    def lookup(self, itemID) :
+        """ Return (size, created) for the entry, or None if the entry is not in the index """
+        with self.lock :
+            return self.conn.execute('SELECT size, created FROM entries WHERE itemID = ?', (itemID,)).fetchone()
+
+    def recordStore(self, itemID, size, created=None) :
+        now = time.time()
+        with self.lock, self.conn :
+            self.pendingAccesses.pop(itemID, None)
+            self.conn.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                              (itemID, size, created if created != None else now, now))
+
+    def recordExtraSize(self, itemID, extraSize) :
+        with self.lock, self.conn :
+            self.conn.execute('UPDATE entries SET size = size + ? WHERE itemID = ?', (extraSize, itemID))
+
+    def recordAccess(self, itemID) :
+        with self.lock :
+            self.pendingAccesses[itemID] = time.time()
+            if len(self.pendingAccesses) >= self.accessFlushCount or \
+               time.monotonic() - self.lastAccessFlush >= self.accessFlushSeconds :
+                self.writePendingAccesses()
+
+    def flushAccesses(self) :
+        """ Write any pending last-access times to the index """
+        with self.lock :
+            self.writePendingAccesses()
+
+    @classmethod
+    def flushAllAccesses(cls) :
+        """ Write any pending last-access times to all the indexes in use in the process """
+        with cls.indexesLock :
+            indexes = list(cls.indexes.values())
+        for index in indexes :
+            index.flushAccesses()
+
+    def flushAccessesAtExit(self) :
+        try :
+            self.flushAccesses()
+        except sqlite3.Error as e :
+            logger.error('Failed to write last-access times to cache index %s: %s', self.indexFile, e)
+
+    def writePendingAccesses(self) :
+        # Caller must hold self.lock
+        self.lastAccessFlush = time.monotonic()
+        if len(self.pendingAccesses) == 0 :
+            return
+        with self.conn :
+            self.conn.executemany('UPDATE entries SET lastAccess = ? WHERE itemID = ?',
+                                  [(lastAccess, itemID) for itemID, lastAccess in self.pendingAccesses.items()])
+        self.pendingAccesses.clear()
+
+    def remove(self, itemIDs) :
+        with self.lock, self.conn :
+            for itemID in itemIDs :
+                self.pendingAccesses.pop(itemID, None)
+            self.conn.executemany('DELETE FROM entries WHERE itemID = ?', [(itemID,) for itemID in itemIDs])
+
+    def usage(self) :
+        """ Return (number of entries, total bytes) for the cache location """
+        with self.lock :
+            count, totalBytes = self.conn.execute('SELECT COUNT(*), SUM(size) FROM entries').fetchone()
+        return count, totalBytes or 0
+
+    def createdBefore(self, cutoff) :
+        """ Return [(itemID, size)] for entries created before the cutoff time """
+        with self.lock :
+            return self.conn.execute('SELECT itemID, size FROM entries WHERE created < ?', (cutoff,)).fetchall()
+
+    def leastRecentlyUsed(self, limit) :
+        """ Return [(itemID, size)] for the least-recently-used entries, oldest first """
+        with self.lock :
+            self.writePendingAccesses()
+            return self.conn.execute('SELECT itemID, size FROM entries ORDER BY lastAccess LIMIT ?', (limit,)).fetchall()
+
+class MemoryTier :
+    """ Bounded least-recently-used store of responses held in memory, shared by all Cacher objects. Entries are
+        keyed on (cache location, item ID) and hold the response with the time it was originally cached. """
+
+    # Environment variable which can be used to enable the tier, giving the maximum number of entries.
+    envVarName = 'RESPONSE_CACHE_MEMORY_ENTRIES'
+
+    def __init__(self, maxEntries) :
+        self.maxEntries = maxEntries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    @classmethod
+    def fromEnvironment(cls) :
+        """ Return a memory tier if one is requested by the environment variable, otherwise None """
+        maxEntries = os.environ.get(cls.envVarName)
+        return cls(int(maxEntries)) if maxEntries else None
+
+    def get(self, key) :
+        """ Return (response, created) for the key, or None """
+        with self.lock :
+            entry = self.entries.get(key)
+            if entry != None :
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, response, created) :
+        with self.lock :
+            self.entries[key] = (response, created)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxEntries :
+                self.entries.popitem(last=False)
+
+    def remove(self, key) :
+        with self.lock :
+            self.entries.pop(key, None)
+
+    def clear(self) :
+        with self.lock :
+            self.entries.clear()
+
+class ItemLock :
+    """ Exclusive lock on a cache item, effective across threads (using a threading lock) and across processes on
+        the same host (using a lock file). To avoid creating a lock file per item, items are spread across a
+        fixed set of lock files, so occasionally unrelated items will share a lock. """
+
+    lockStripes = 256
+    lockDirName = '.locks'
+
+    threadLocks = {}
+    threadLocksLock = threading.Lock()
+
+    def __init__(self, cacheLocation, itemID) :
+        stripe = int(hashlib.sha256(itemID.encode('utf-8')).hexdigest()[0:8], 16) % self.lockStripes
+        self.lockFile = os.path.join(cacheLocation, self.lockDirName, '{0:02x}.lock'.format(stripe))
+        with self.threadLocksLock :
+            self.threadLock = self.threadLocks.setdefault(self.lockFile, threading.Lock())
+        self.f = None
+
+    def __enter__(self) :
+        self.threadLock.acquire()
+        try :
+            os.makedirs(os.path.dirname(self.lockFile), exist_ok=True)
+            self.f = open(self.lockFile, 'a+b')
+            if fcntl != None :
+                fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+            else :
+                # msvcrt only retries for a few seconds before giving up, so keep trying.
+                self.f.seek(0)
+                while True :
+                    try :
+                        msvcrt.locking(self.f.fileno(), msvcrt.LK_LOCK, 1)
+                        break
+                    except OSError :
+                        pass
+        except BaseException :
+            if self.f != None :
+                self.f.close()
+            self.threadLock.release()
+            raise
+        return self
+
+    def __exit__(self, *excInfo) :
+        try :
+            if fcntl != None :
+                fcntl.flock(self.f.fileno(), fcntl.LOCK_UN)
+            else :
+                self.f.seek(0)
+                msvcrt.locking(self.f.fileno(), msvcrt.LK_UNLCK, 1)
+            self.f.close()
+        finally :
+            self.f = None
+            self.threadLock.release()
+
+class RateLimiter :
+    """ Spaces out calls so that no more than maxCallsPerSecond start in any second, across all threads using it """
+
+    def __init__(self, maxCallsPerSecond) :
+        self.interval = 1.0 / maxCallsPerSecond
+        self.nextCallTime = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self) :
+        with self.lock :
+            now = time.monotonic()
+            callTime = max(now, self.nextCallTime)
+            self.nextCallTime = callTime + self.interval
+        if callTime > now :
+            time.sleep(callTime - now)
+
+class PrettyDumpWriter :
+    """ Background thread writing human-readable versions of stored responses, so that formatting them doesn't
+        slow down the caller. Any queued work is completed before the process exits, or when Cacher.flush() is
+        called. """
+
+    # Queued work holds the whole response, so the queue is limited in size: once it is full, callers storing
+    # responses wait for the writer to catch up.
+    maxQueued = 100
+
+    def __init__(self) :
+        self.queue = queue.Queue(maxsize=self.maxQueued)
+        self.thread = threading.Thread(target=self.run, name='PrettyDumpWriter', daemon=True)
+        self.thread.start()
+        atexit.register(self.queue.join)
+
+    def submit(self, cacher, response) :
+        self.queue.put((cacher, response))
+
+    def flush(self) :
+        """ Wait until all the queued work has been done """
+        self.queue.join()
+
+    def run(self) :
+        while True :
+            cacher, response = self.queue.get()
+            try :
+                cacher.writePrettyDump(response)
+            except Exception as e :
+                logger.error('Failed to write formatted %s response for %s: %s', cacher.itemTypeName, cacher.itemID, e)
+            finally :
+                self.queue.task_done()
+
+# #####################################################################################################
 
 class Cacher :
 
     # Use cache folder specified in environment, if present, otherwise a default.
     envVarName = 'RESPONSE_CACHE_LOCATION'
 
-    def __init__(self, itemTypeName, itemID) :
+    # Use the storage backend specified in the environment, if present, otherwise the directory backend.
+    backendEnvVarName = 'RESPONSE_CACHE_BACKEND'
+    defaultBackendName = os.environ.get(backendEnvVarName, DirectoryBackend.name)
+
+    # Format used to serialise responses, from the environment if specified there.
+    formatEnvVarName = 'RESPONSE_CACHE_FORMAT'
+    defaultFormatName = os.environ.get(formatEnvVarName, 'pickle')
+
+    # When to write the human-readable form of a response: 'eager', 'background' or 'lazy', from the
+    # environment if specified there.
+    prettyDumpEnvVarName = 'RESPONSE_CACHE_PRETTY_DUMP'
+    prettyDumpModes = ('eager', 'background', 'lazy')
+    defaultPrettyDumpMode = os.environ.get(prettyDumpEnvVarName, 'background')
+
+    # Shared background writer for human-readable dumps, started when first needed.
+    prettyDumpWriter = None
+    prettyDumpWriterLock = threading.Lock()
+
+    # Limits applied to the cache, unless a policy is passed in when the Cacher is created.
+    defaultPolicy = CachePolicy.fromEnvironment()
+
+    # Activity counters, shared by all Cacher objects, and optional log of each event.
+    stats = CacheStats()
+    metricsLog = MetricsLog.fromEnvironment(stats)
+
+    # Optional in-memory tier in front of the cache files, shared by all Cacher objects.
+    memoryTier = MemoryTier.fromEnvironment()
+
+    @classmethod
+    def enableMemoryTier(cls, maxEntries=256) :
+        """ Hold up to maxEntries recently used responses in memory, for all Cacher objects in the process """
+        cls.memoryTier = MemoryTier(maxEntries)
+
+    @classmethod
+    def disableMemoryTier(cls) :
+        cls.memoryTier = None
+
+    def __init__(self, itemTypeName, itemID, policy=None, backendName=None, prettyDump=None, formatName=None) :
         self.itemTypeName = itemTypeName
         self.itemID = itemID
+        self.policy = policy if policy != None else self.defaultPolicy
+        self.formatName = formatName or self.defaultFormatName
+        checkFormatName(self.formatName)
+        self.prettyDump = prettyDump or self.defaultPrettyDumpMode
+        if self.prettyDump not in self.prettyDumpModes :
+            raise ValueError('Unknown pretty dump mode {0}, expected one of {1}'.format(self.prettyDump, self.prettyDumpModes))
 
-    def findCachedResponse(self) :
-        response = None
         cacheDefault = os.path.join(os.path.dirname(__file__), 'responsesCache/' + self.itemTypeName.lower())
         self.cacheLocation = os.environ.get(self.envVarName, cacheDefault)
+        self.backend = openBackend(backendName or self.defaultBackendName, self.cacheLocation)
 
-        # We cache two files per image: a 'pickle' format data structure, and a human-readable form of the same data
-        self.cacheFile = os.path.join(self.cacheLocation, self.itemID + '.response')
-        self.prettyCacheFile = os.path.join(self.cacheLocation, self.itemID + '.response.pretty.txt')
+    @classmethod
+    def forContent(cls, itemTypeName, apiName, payloadDigest, parameters=None, **kwargs) :
+        """ Return a Cacher using a content-addressed item ID - see contentItemID() """
+        return cls(itemTypeName, contentItemID(apiName, payloadDigest, parameters), **kwargs)
 
-        if os.path.isfile(self.cacheFile) :
-            print('Cache file {0} found ..'.format(self. cacheFile))
+    def getIndex(self) :
+        """ Return the index for this cache location, or None if no limits apply so no index is needed """
+        return CacheIndex.forBackend(self.backend) if self.policy.isBounded() else None
 
-            with open(self.cacheFile, 'rb') as f:
-                response = pickle.load(f)
-                print('.. read pre-existing {0} response from cache file'.format(self.itemTypeName))
+    def usage(self) :
+        """ Return (number of entries, total bytes) for the cache location, if it has an index """
+        index = self.getIndex()
+        return index.usage() if index != None else None
+
+    def findCachedResponse(self, recordMiss=True) :
+        response = None
+
+        # Try the in-memory tier first. NB the response object returned is shared with any other
+        # callers who look up the same item, so shouldn't be modified.
+        memoryKey = (self.cacheLocation, self.itemID)
+        if self.memoryTier != None :
+            entry = self.memoryTier.get(memoryKey)
+            if entry != None :
+                response, created = entry
+                if self.policy.ttlSeconds == None or created >= time.time() - self.policy.ttlSeconds :
+                    self.stats.add('hits')
+                    self.stats.add('memoryHits')
+                    self.recordEvent('hit', tier='memory')
+                    # Keep the index's least-recently-used order up to date, so the policy doesn't evict the
+                    # entries which are being used most. Index access times are written in batches, so this
+                    # is cheap.
+                    index = self.getIndex()
+                    if index != None :
+                        index.recordAccess(self.itemID)
+                    return response
+                # Expired - drop it from memory, and let the file-based handling below deal with the file.
+                self.memoryTier.remove(memoryKey)
+                response = None
+
+        index = self.getIndex()
+        itemDescription = self.backend.describe(self.itemID)
+
+        start = time.perf_counter()
+        data = self.backend.read(self.itemID)
+        if data != None and self.hasExpired(index, len(data)) :
+            logger.debug('Expired %s', itemDescription)
+            self.removeEntries([self.itemID], index)
+            self.stats.add('expirations')
+            self.recordEvent('expiry')
+            data = None
+
+        if data != None :
+            response = deserialiseResponse(data)
+            loadSeconds = time.perf_counter() - start
+            logger.debug('Read pre-existing %s response from %s', self.itemTypeName, itemDescription)
+            self.stats.add('hits')
+            self.stats.add('bytesRead', len(data))
+            self.stats.add('loadSeconds', loadSeconds)
+            self.recordEvent('hit', tier=self.backend.name, bytes=len(data), seconds=loadSeconds)
+            if index != None :
+                index.recordAccess(self.itemID)
+            if self.memoryTier != None :
+                entry = index.lookup(self.itemID) if index != None else None
+                created = entry[1] if entry != None else self.backend.createdTime(self.itemID)
+                self.memoryTier.put(memoryKey, response, created)
         else :
-            print('No cache file {0} found.'.format(self.cacheFile))
+            logger.debug('No %s found', itemDescription)
+            if recordMiss :
+                self.stats.add('misses')
+                self.recordEvent('miss')
 
         return response
 
     def storeResponseInCache(self, response) :
 
-        if not os.path.isdir(self.cacheLocation) :
-            os.makedirs(self.cacheLocation)
-            print('Created {0} cache location {1}'.format(self.itemTypeName, self.cacheLocation))
+        # Serialise the response data into binary form to cache it.
+        start = time.perf_counter()
+        size = self.backend.write(self.itemID, serialiseResponse(response, self.formatName))
+        storeSeconds = time.perf_counter() - start
+        logger.debug('Written %s response as %s object to %s', self.itemTypeName, self.formatName, self.backend.describe(self.itemID))
 
-        # Use pickle to cache the response data.
-        with open(self.cacheFile, 'wb') as f:
-            pickle.dump(response, f)
-            print('Written {0} response as binary object to cache file {1}'.format(self.itemTypeName, self.cacheFile))
+        # Produce a human-readable version of the response data structure, and cache this too, now or
+        # in the background, depending on the mode. Skipped entirely if the backend doesn't keep it.
+        prettySize = 0
+        if self.backend.keepsPrettyDumps :
+            if self.prettyDump == 'eager' :
+                prettySize = self.writePrettyDump(response, updateIndex=False)
+                size += prettySize
+            elif self.prettyDump == 'background' :
+                self.getPrettyDumpWriter().submit(self, response)
 
-        # Produce a human-readable version of the response data structure, and cache this too.
-        pp = pprint.PrettyPrinter(indent=4)
-        pstring = pp.pformat(response)
-        with open(self.prettyCacheFile, 'w', encoding='utf-8') as f:
-            f.write(pstring)
-            print('Dumped formatted {0} response to file {1}'.format(self.itemTypeName, self.prettyCacheFile))
+        if self.memoryTier != None :
+            self.memoryTier.put((self.cacheLocation, self.itemID), response, time.time())
+
+        self.stats.add('stores')
+        self.stats.add('bytesWritten', size - prettySize)
+        self.stats.add('storeSeconds', storeSeconds)
+        self.recordEvent('store', bytes=size - prettySize, seconds=storeSeconds)
+
+        index = self.getIndex()
+        if index != None :
+            index.recordStore(self.itemID, size)
+            self.enforcePolicy(index)
+
+        return response
+
+    def getOrFetch(self, fetchFunction) :
+        """ Return the cached response if there is one, otherwise call fetchFunction() to obtain the response and
+            store it in the cache. If several threads or processes ask for the same item at once, only one of
+            them calls fetchFunction(), and the others wait and then use the response it stored. """
+
+        response = self.findCachedResponse(recordMiss=False)
+        if response != None :
+            return response
+
+        with ItemLock(self.cacheLocation, self.itemID) :
+            # Someone else may have fetched the response while we were waiting for the lock.
+            response = self.findCachedResponse()
+            if response == None :
+                start = time.perf_counter()
+                response = fetchFunction()
+                fetchSeconds = time.perf_counter() - start
+                self.stats.add('fetches')
+                self.stats.add('fetchSeconds', fetchSeconds)
+                self.recordEvent('fetch', seconds=fetchSeconds)
+                self.storeResponseInCache(response)
 
         return response
+
+    def isCached(self) :
+        """ Is there an unexpired cached response for this item ? Doesn't read the response itself. """
+
+        if self.memoryTier != None :
+            entry = self.memoryTier.get((self.cacheLocation, self.itemID))
+            if entry != None and (self.policy.ttlSeconds == None or entry[1] >= time.time() - self.policy.ttlSeconds) :
+                return True
+        if not self.backend.contains(self.itemID) :
+            return False
+        index = self.getIndex()
+        if index == None or self.policy.ttlSeconds == None :
+            return True
+        entry = index.lookup(self.itemID)
+        created = entry[1] if entry != None else self.backend.createdTime(self.itemID)
+        return created >= time.time() - self.policy.ttlSeconds
+
+    # Bulk operations
+
+    @classmethod
+    def findMissing(cls, itemTypeName, itemIDs, **kwargs) :
+        """ Return the list of item IDs (in the order given) which don't have a cached response """
+        return [ itemID for itemID in itemIDs if not cls(itemTypeName, itemID, **kwargs).isCached() ]
+
+    @classmethod
+    def prefetch(cls, itemTypeName, itemIDs, fetchFunction, maxWorkers=4, maxCallsPerSecond=None, **kwargs) :
+        """ Make sure all the items have cached responses, calling fetchFunction(itemID) for each missing item to
+            obtain its response. Missing items are fetched concurrently by up to maxWorkers threads, with no more
+            than maxCallsPerSecond calls to fetchFunction started per second (if specified).
+
+            Returns a dictionary of item ID to exception for any items which could not be fetched. """
+
+        missing = cls.findMissing(itemTypeName, itemIDs, **kwargs)
+        logger.info('%d of %d %s items need fetching', len(missing), len(itemIDs), itemTypeName)
+
+        rateLimiter = RateLimiter(maxCallsPerSecond) if maxCallsPerSecond else None
+
+        def fetchItem(itemID) :
+            if rateLimiter != None :
+                rateLimiter.wait()
+            # getOrFetch re-checks the cache under the item lock, in case another process got there first.
+            cls(itemTypeName, itemID, **kwargs).getOrFetch(lambda : fetchFunction(itemID))
+
+        failures = {}
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor :
+            futures = { executor.submit(fetchItem, itemID) : itemID for itemID in missing }
+            for future in as_completed(futures) :
+                itemID = futures[future]
+                try :
+                    future.result()
+                except Exception as e :
+                    logger.error('Failed to fetch %s item %s: %s', itemTypeName, itemID, e)
+                    failures[itemID] = e
+
+        logger.info('Fetched %d %s items, %d failed', len(missing) - len(failures), itemTypeName, len(failures))
+        return failures
+
+    def recordEvent(self, event, **fields) :
+        if self.metricsLog != None :
+            self.metricsLog.record(event, itemType=self.itemTypeName, itemID=self.itemID, **fields)
+
+    # Human-readable dumps
+
+    @classmethod
+    def getPrettyDumpWriter(cls) :
+        with cls.prettyDumpWriterLock :
+            if cls.prettyDumpWriter == None :
+                cls.prettyDumpWriter = PrettyDumpWriter()
+            return cls.prettyDumpWriter
+
+    @classmethod
+    def flush(cls) :
+        """ Write out any human-readable dumps still queued for the background writer, and any index last-access
+            times not yet written. This happens anyway when the process exits normally, but not in worker processes
+            (e.g. in a multiprocessing pool), where exit handlers aren't run, so worker functions using the cache
+            should call this before returning. """
+        with cls.prettyDumpWriterLock :
+            writer = cls.prettyDumpWriter
+        if writer != None :
+            writer.flush()
+        CacheIndex.flushAllAccesses()
+
+    @classmethod
+    def close(cls) :
+        """ Flush, and write the summary line to the metrics log (if there is one), as is done at normal exit. For
+            worker processes, e.g. register with multiprocessing.util.Finalize in the pool's initializer. """
+        cls.flush()
+        if cls.metricsLog != None :
+            cls.metricsLog.close()
+
+    def formatResponse(self, response) :
+        pp = pprint.PrettyPrinter(indent=4)
+        return pp.pformat(response)
+
+    def writePrettyDump(self, response, updateIndex=True) :
+        """ Write the human-readable version of the response, if the backend keeps one, returning its size """
+        if not self.backend.keepsPrettyDumps :
+            return 0
+        prettySize = self.backend.writePretty(self.itemID, self.formatResponse(response))
+        if prettySize > 0 :
+            logger.debug('Dumped formatted %s response to cache', self.itemTypeName)
+            self.stats.add('bytesWritten', prettySize)
+            index = self.getIndex()
+            if updateIndex and index != None :
+                index.recordExtraSize(self.itemID, prettySize)
+        return prettySize
+
+    def dump(self) :
+        """ Return the human-readable version of the cached response, also writing it to the cache if the
+            backend keeps one. Returns None if the response is not in the cache. """
+        response = self.findCachedResponse()
+        if response == None :
+            return None
+        self.writePrettyDump(response)
+        return self.formatResponse(response)
+
+    # Policy enforcement
+
+    def hasExpired(self, index, size) :
+        """ Has this entry passed the policy's time-to-live ? """
+        if index == None or self.policy.ttlSeconds == None :
+            return False
+        entry = index.lookup(self.itemID)
+        if entry == None :
+            # Not indexed yet (e.g. written by a process with no policy), so index it now using the backend's
+            # record of when it was created.
+            entry = (size, self.backend.createdTime(self.itemID))
+            index.recordStore(self.itemID, size, created=entry[1])
+        return entry[1] < time.time() - self.policy.ttlSeconds
+
+    def enforcePolicy(self, index) :
+        """ Remove expired entries, then least-recently-used entries until the cache is within its limits """
+
+        policy = self.policy
+        if policy.ttlSeconds != None :
+            expired = index.createdBefore(time.time() - policy.ttlSeconds)
+            if len(expired) > 0 :
+                self.removeEntries([itemID for itemID, _ in expired], index)
+                self.stats.add('expirations', len(expired))
+                self.stats.add('bytesEvicted', sum(size for _, size in expired))
+                self.recordEvent('expiry', count=len(expired))
+
+        count, totalBytes = index.usage()
+        while policy.isExceeded(count, totalBytes) :
+            # Evict in small batches, oldest access first, re-checking the limits after each batch.
+            excessEntries = count - policy.maxEntries if policy.maxEntries != None else 0
+            candidates = index.leastRecentlyUsed(max(excessEntries, 10))
+            victims = []
+            for itemID, size in candidates :
+                if itemID == self.itemID :
+                    continue        # Never evict the entry we've just stored
+                if not policy.isExceeded(count, totalBytes) :
+                    break
+                victims.append(itemID)
+                count -= 1
+                totalBytes -= size
+                self.stats.add('bytesEvicted', size)
+            if len(victims) == 0 :
+                break
+            self.removeEntries(victims, index)
+            self.stats.add('evictions', len(victims))
+            self.recordEvent('eviction', count=len(victims))
+            logger.info('Evicted %d %s cache entries', len(victims), self.itemTypeName)
+
+    def removeEntries(self, itemIDs, index) :
+        self.backend.delete(itemIDs)
+        if index != None :
+            index.remove(itemIDs)
+        if self.memoryTier != None :
+            for itemID in itemIDs :
+                self.memoryTier.remove((self.cacheLocation, itemID))
+
+# #####################################################################################################
+
+# Maintenance commands, run as 'python Cacher.py <command> ...'
+
+def findDirectoryLocations(tree) :
+    """ Generate the directory-backend cache locations found in a directory tree """
+    for dirPath, dirNames, fileNames in os.walk(tree) :
+        if ItemLock.lockDirName in dirNames :
+            dirNames.remove(ItemLock.lockDirName)
+        if DirectoryBackend.layoutFileName in fileNames or any(fileName.endswith(DirectoryBackend.responseSuffix) for fileName in fileNames) :
+            # Don't treat the shard directories of a sharded location as locations in their own right.
+            dirNames[:] = [ dirName for dirName in dirNames if len(dirName) != 2 ]
+            yield dirPath
+
+def reshardDirectoryTree(tree, newLayout) :
+    """ Convert every directory-backend cache location in the tree to the new layout, in place """
+
+    for location in findDirectoryLocations(tree) :
+        backend = DirectoryBackend(location)
+        oldLayout = backend.layout
+        movedCount = backend.reshard(newLayout)
+        print('Moved {0} items in {1} from {2} to {3} layout'.format(movedCount, location, oldLayout, newLayout))
+
+def migrateDirectoryTree(sourceTree, targetTree, targetBackendName=SQLiteBackend.name) :
+    """ Import every directory-backend cache location found under sourceTree into the equivalent location
+        under targetTree, using the target backend. The source files are left in place. """
+
+    totalItems = 0
+    for dirPath in findDirectoryLocations(sourceTree) :
+        source = DirectoryBackend(dirPath)
+        target = openBackend(targetBackendName, os.path.join(targetTree, os.path.relpath(dirPath, sourceTree)))
+        itemCount = 0
+        for itemID, _, created in source.entries() :
+            target.write(itemID, source.read(itemID), created=created)
+            itemCount += 1
+
+        # If the target location already has a policy index, bring it up to date with the imported items.
+        if CacheIndex.existsFor(target) :
+            CacheIndex.forBackend(target).addExistingEntries()
+
+        print('Imported {0} items from {1} into {2} backend at {3}'.format(itemCount, dirPath, target.name, target.cacheLocation))
+        totalItems += itemCount
+
+    print('Imported {0} items in total'.format(totalItems))
+    return totalItems
+
+def benchmarkFormats(backend, formatNames=None, repeats=3) :
+    """ Report the bytes on disk and the store/load times for each format, using the responses held in a backend """
+
+    responses = [ deserialiseResponse(backend.read(itemID)) for itemID, _, _ in backend.entries() ]
+    if len(responses) == 0 :
+        print('No cached responses found at {0}'.format(backend.cacheLocation))
+        return
+
+    if formatNames == None :
+        formatNames = ['pickle', 'pickle+gzip', 'json', 'json+gzip', 'json+zstd', 'msgpack', 'msgpack+zstd']
+
+    print('Benchmarking {0} responses from {1}'.format(len(responses), backend.cacheLocation))
+    print()
+    print('{0:15s} {1:>12s} {2:>8s} {3:>12s} {4:>12s}'.format('Format', 'Bytes', 'Ratio', 'Store ms', 'Load ms'))
+
+    baseBytes = None
+    with tempfile.TemporaryDirectory() as tempDir :
+        for formatName in formatNames :
+            # Write and read back every response through a directory backend, so the times include the file I/O.
+            target = DirectoryBackend(os.path.join(tempDir, formatName))
+            os.makedirs(target.cacheLocation)
+            try :
+                storeTime = loadTime = 0.0
+                for _ in range(repeats) :
+                    totalBytes = 0
+                    start = time.perf_counter()
+                    for n, response in enumerate(responses) :
+                        totalBytes += target.write(str(n), serialiseResponse(response, formatName))
+                    storeTime += time.perf_counter() - start
+                    start = time.perf_counter()
+                    for n in range(len(responses)) :
+                        deserialiseResponse(target.read(str(n)))
+                    loadTime += time.perf_counter() - start
+            except ImportError as e :
+                print('{0:15s} not available: {1}'.format(formatName, e))
+                continue
+
+            baseBytes = baseBytes or totalBytes
+            print('{0:15s} {1:12d} {2:8.2f} {3:12.2f} {4:12.2f}'.format(formatName, totalBytes, totalBytes / baseBytes,
+                    1000 * storeTime / repeats, 1000 * loadTime / repeats))
+
+def main(argv) :
+
+    usage = '\n'.join([
+        'Usage: python Cacher.py migrate <source cache directory> [<target cache directory>]',
+        '       python Cacher.py dump <item type> <item ID>',
+        '       python Cacher.py bench <item type> [<format> ...]',
+        '       python Cacher.py reshard <cache directory> [flat|sharded]'
+        ])
+
+    if len(argv) < 2 :
+        print(usage)
+        return
+
+    command = argv[1]
+    if command == 'migrate' and len(argv) > 2 :
+        sourceTree = argv[2]
+        targetTree = argv[3] if len(argv) > 3 else sourceTree
+        if not os.path.isdir(sourceTree) :
+            print()
+            print('*** Directory {0} not found'.format(sourceTree))
+            return
+        migrateDirectoryTree(sourceTree, targetTree)
+    elif command == 'dump' and len(argv) > 3 :
+        itemTypeName, itemID = argv[2], argv[3]
+        pstring = Cacher(itemTypeName, itemID).dump()
+        if pstring == None :
+            print()
+            print('*** No cached {0} response found for {1}'.format(itemTypeName, itemID))
+            return
+        print(pstring)
+    elif command == 'bench' and len(argv) > 2 :
+        cacher = Cacher(argv[2], '-')
+        benchmarkFormats(cacher.backend, argv[3:] or None)
+    elif command == 'reshard' and len(argv) > 2 :
+        tree = argv[2]
+        newLayout = argv[3] if len(argv) > 3 else 'sharded'
+        if not os.path.isdir(tree) :
+            print()
+            print('*** Directory {0} not found'.format(tree))
+            return
+        reshardDirectoryTree(tree, newLayout)
+    else :
+        print(usage)
+
+# #####################################################################################################
+
+if __name__ == '__main__' :
+    main(sys.argv)
@@ -0,0 +1,106 @@
+# Read basic information (currently the dimensions) about JPEG and PNG image files from the file headers,
+# without reading and decoding the pixel data of the whole image. Much quicker than reading the image
+# into an array, when the dimensions are all we need.
+#
+# JPEG: https://www.w3.org/Graphics/JPEG/itu-t81.pdf (section B.2)
+# PNG:  https://www.w3.org/TR/PNG/#11IHDR
+
+import sys
+import os
+import struct
+
+# #####################################################################################################
+
+pngSignature = b'\x89PNG\r\n\x1a\n'
+
+# JPEG 'start of frame' markers, which hold the image dimensions. 0xC4 (define Huffman tables), 0xC8
+# (reserved) and 0xCC (define arithmetic coding) are in the same range but are not frame markers.
+jpegSOFMarkers = set(range(0xC0, 0xD0)) - { 0xC4, 0xC8, 0xCC }
+
+# JPEG markers which stand alone, without a length and segment data following them.
+jpegStandaloneMarkers = set(range(0xD0, 0xDA)) | { 0x01 }
+
+def readPNGDimensions(f) :
+    """ Return (height, width) from the IHDR chunk, which always immediately follows the PNG signature """
+    header = f.read(16)         # Chunk length, chunk type, then the start of the chunk data
+    if len(header) < 16 or header[4:8] != b'IHDR' :
+        return None
+    width, height = struct.unpack('>II', header[8:16])
+    return height, width
+
+def readJPEGDimensions(f) :
+    """ Return (height, width) from the first JPEG start-of-frame segment, skipping over the segments before it """
+    f.seek(2)       # Skip the start-of-image marker
+    while True :
+        # Find the next marker, skipping any 0xFF padding bytes.
+        b = f.read(1)
+        while b == b'\xff' :
+            marker = f.read(1)
+            if marker != b'\xff' :
+                break
+            b = marker
+        else :
+            return None     # Not at a marker, or end of file
+        if marker == b'' :
+            return None
+
+        markerCode = marker[0]
+        if markerCode in jpegStandaloneMarkers :
+            continue
+        if markerCode == 0xDA or markerCode == 0xD9 :
+            return None     # Start of scan/end of image without finding a frame header
+
+        lengthBytes = f.read(2)
+        if len(lengthBytes) < 2 :
+            return None
+        segmentLength = struct.unpack('>H', lengthBytes)[0]
+        if markerCode in jpegSOFMarkers :
+            frameHeader = f.read(5)
+            if len(frameHeader) < 5 :
+                return None
+            _, height, width = struct.unpack('>BHH', frameHeader)
+            return height, width
+        f.seek(segmentLength - 2, os.SEEK_CUR)
+
+def readImageDimensions(imgFile) :
+    """ Return (height, width) in pixels for a JPEG or PNG image file, reading only the file header. Returns None
+        if the file isn't a JPEG or PNG image, or the header can't be understood. """
+
+    with open(imgFile, 'rb') as f :
+        start = f.read(8)
+        if start == pngSignature :
+            return readPNGDimensions(f)
+        if start[0:2] == b'\xff\xd8' :
+            return readJPEGDimensions(f)
+    return None
+
+def getImageDimensions(imgFile) :
+    """ Return (height, width) in pixels for an image file, reading just the file header for JPEG and PNG files,
+        and using Pillow (which also only reads the header) for other image formats. """
+
+    dimensions = readImageDimensions(imgFile)
+    if dimensions == None :
+        from PIL import Image
+        with Image.open(imgFile) as img :
+            dimensions = (img.size[1], img.size[0])
+    return dimensions
+
+# #####################################################################################################
+
+def main(argv) :
+
+    if len(argv) < 2 :
+        print('Usage: python ImageHeaders.py <image file> ...')
+        return
+
+    for imgFile in argv[1:] :
+        if not os.path.isfile(imgFile) :
+            print('*** File {0} not found'.format(imgFile))
+            continue
+        height, width = getImageDimensions(imgFile)
+        print('{0} : {1} x {2}'.format(imgFile, height, width))
+
+# #####################################################################################################
+
+if __name__ == '__main__' :
+    main(sys.argv)
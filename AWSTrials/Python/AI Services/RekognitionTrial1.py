@@ -7,9 +7,23 @@
 # - MatPlotLib
 # - Pillow
 # - OpenCV
+#
+# Can also be run in batch mode, to detect labels for all the images in a directory (or listed in a
+# manifest file) using a pool of threads, with a summary table at the end:
+#
+#   python RekognitionTrial1.py --batch <directory or manifest file> [<number of threads> [<max dimension>]]
+#
+# Needs these packages installed in the Python environment (e.g. with pip install):
+# - boto3
+# - numpy
+# - Pillow (pip install pillow) - used to read every input image, so needed in all modes, including batch mode
+# - matplotlib and opencv-python - only needed for the corresponding display functions
 
 import sys
 import os
+import threading
+import time
+from collections.abc import Mapping
 
 import numpy as np      
 import boto3            # Python interface to AWS
@@ -17,6 +31,7 @@ import pickle           # To save Rekognition response in a simple local cache
 import pprint           # Dump Python data structure showing the Rekognition response in a readable format
 
 import Cacher
+import ImageHeaders
 
 # #####################################################################################################
 
@@ -26,40 +41,168 @@ import Cacher
 #   Rekognition processing time
 # - also avoids some AWS charging for Rekognition use
 
-def detectLabelsFromLocalFile(imgFile) :
-    """ Return Rekognition label data (in Boto3 form) extracted from the specified image file. """
+# A single Rekognition client is shared by all threads (boto3 clients are thread-safe, unlike sessions),
+# created when first needed. The client is configured to use boto3's 'adaptive' retry mode, which backs off
+# and slows down the rate of requests when Rekognition reports throttling (i.e. when we exceed the account's
+# transactions-per-second limit).
+rekognitionClient = None
+rekognitionClientLock = threading.Lock()
+rekognitionClientMaxConnections = 10        # Should be at least the number of threads using the client
+
+def getRekognitionClient() :
+    """ Return the shared Rekognition client, creating it if necessary """
+
+    global rekognitionClient
+    with rekognitionClientLock :
+        if rekognitionClient == None :
+            from botocore.config import Config
+            config = Config(max_pool_connections=rekognitionClientMaxConnections, retries={ 'mode' : 'adaptive', 'max_attempts' : 10 })
+            rekognitionClient = boto3.client('rekognition', config=config)
+        return rekognitionClient
+
+# Large images can be reduced in size before being sent to Rekognition, which cuts the upload time, and
+# is needed for images over Rekognition's limit for images passed as bytes. Rekognition reports bounding
+# boxes as fractions of the image width and height, so they still apply to the original image as long as
+# the aspect ratio is kept.
+
+rekognitionMaxImageBytes = 5 * 1024 * 1024      # Limit on image size when passing bytes to Rekognition
+oversizeMaxDimension = 4096                     # Default size to reduce over-limit images to
+reducedMinJpegQuality = 60                      # Lowest JPEG quality used to bring a reduced image under the limit
+
+def reduceImage(imageBytes, maxDimension, jpegQuality=90, maxBytes=None) :
+    """ Return the image as JPEG bytes, scaled down (keeping the aspect ratio) so neither side is larger than
+        maxDimension pixels. If maxBytes is specified and the result is larger than that (e.g. for a very detailed
+        or noisy image), the JPEG quality is lowered, and then the image scaled down further, until it fits. """
+
+    from io import BytesIO
+    from PIL import Image
+
+    # NB EXIF orientation is deliberately not applied, so the reduced image has the same orientation as the
+    # pixel arrays we read from the original file.
+    img = Image.open(BytesIO(imageBytes))
+    img.thumbnail((maxDimension, maxDimension), Image.LANCZOS)
+    if img.mode != 'RGB' :
+        img = img.convert('RGB')
+
+    quality = jpegQuality
+    while True :
+        output = BytesIO()
+        img.save(output, format='JPEG', quality=quality)
+        if maxBytes == None or output.tell() <= maxBytes :
+            return output.getvalue()
+        if quality > reducedMinJpegQuality :
+            quality = max(quality - 10, reducedMinJpegQuality)
+        else :
+            img.thumbnail((img.width * 3 // 4, img.height * 3 // 4), Image.LANCZOS)
+
+def detectLabelsFromLocalFile(imgFile, maxDimension=None, jpegQuality=90) :
+    """ Return Rekognition label data (in Boto3 form) extracted from the specified image file. If maxDimension is
+        specified, the image is reduced to fit within maxDimension x maxDimension pixels and re-encoded as JPEG
+        before it is sent to Rekognition. Images too large to send are always reduced, to no more than the size
+        Rekognition accepts. """
+
+    # Check for a cached response file, using a digest of the image bytes as the cache key, so that
+    # different images with the same file name don't collide, and the same image under different
+    # file names only needs one Rekognition call. The file is read once, with the digest calculated
+    # as it is read, and the bytes kept in case we need to send them to Rekognition.
+    imageBytes, imageDigest = Cacher.readAndDigestFile(imgFile)
+
+    if maxDimension == None and len(imageBytes) > rekognitionMaxImageBytes :
+        maxDimension = oversizeMaxDimension
+
+    # Any reduction of the image affects what Rekognition finds, so is included in the cache key. The
+    # reduction itself is only done if we need to call Rekognition.
+    parameters = { 'maxDimension' : maxDimension, 'jpegQuality' : jpegQuality } if maxDimension != None else None
+    cacher = Cacher.Cacher.forContent('Rekognition', 'detect_labels', imageDigest, parameters)
+
+    def invokeRekognition() :
+        uploadBytes = imageBytes
+        if maxDimension != None :
+            uploadBytes = reduceImage(imageBytes, maxDimension, jpegQuality, rekognitionMaxImageBytes)
+            print('Reduced image from {0} to {1} bytes for upload'.format(len(imageBytes), len(uploadBytes)))
 
-    # Check for a cached response file, using the image file name as the cache key. NB Will need
-    # something more sophisticated to allow different images in files of the same base name to be used.
-    imgFileBasename = os.path.basename(imgFile)
-    cacher = Cacher.Cacher('Rekognition', imgFileBasename)
-    cachedResponse = cacher.findCachedResponse()
-    if cachedResponse == None :
         # Use boto3 to make the Rekognition 'detect labels' call, passing in the image as 
         # bytes (which Boto3 presumably converts to base-64 encoding).
         print('Invoking Rekognition ...')
-        client = boto3.client('rekognition')
-        with open(imgFile, 'rb') as image :
-            # Boto3 converts the raw Rekognition HTTP response to a Python data structure. 
-            response = client.detect_labels(Image={'Bytes' : image.read() })
-            print('... response received from Rekognition')
-            cacher.storeResponseInCache(response)
-    else :
-        response = cachedResponse
+        client = getRekognitionClient()
+        # Boto3 converts the raw Rekognition HTTP response to a Python data structure. 
+        response = client.detect_labels(Image={'Bytes' : uploadBytes })
+        print('... response received from Rekognition')
+        return response
 
-    return response
+    # The cacher only invokes Rekognition on a cache miss, and makes sure that only one thread or process
+    # does so if several are processing the same image at once.
+    return cacher.getOrFetch(invokeRekognition)
 
 # #####################################################################################################
 
-def dumpLabelInfo(imgFile, labelsResponse) :
+# The image file is decoded once into an 'image context', which is then passed to each stage that needs the
+# image (summary, instance extraction, drawing, output), rather than each stage reading and decoding the
+# file again using its own library. The context records whether the colour values in the array are in RGB
+# order (MatPlotLib, Pillow) or BGR order (OpenCV), so a stage can get the array in the order it needs.
+
+class ImageContext :
+    """ An image file decoded into a 3-D numpy array [y,x,colour], with the order of the colour values """
+
+    colourOrders = ('RGB', 'BGR')
+
+    def __init__(self, imgFile, imgArray, colourOrder='RGB') :
+        if colourOrder not in self.colourOrders :
+            raise ValueError('Unknown colour order {0}, expected one of {1}'.format(colourOrder, self.colourOrders))
+        self.imgFile = imgFile
+        self.imgArray = imgArray
+        self.colourOrder = colourOrder
+
+    @classmethod
+    def fromFile(cls, imgFile) :
+        """ Decode the image file (using Pillow) into an 8-bit [y,x,RGB] array """
+
+        from PIL import Image
+        with Image.open(imgFile) as img :
+            if img.mode != 'RGB' :
+                img = img.convert('RGB')
+            imgArray = np.array(img)
+        return cls(imgFile, imgArray, 'RGB')
+
+    @property
+    def shape(self) :
+        return self.imgArray.shape
+
+    @property
+    def height(self) :
+        return self.imgArray.shape[0]
+
+    @property
+    def width(self) :
+        return self.imgArray.shape[1]
+
+    def getArray(self, colourOrder='RGB') :
+        """ Return the image array with its colour values in the specified order. The decoded array itself is
+            returned if it is already in that order (so callers must copy it before drawing on it), otherwise
+            a new array with the colour values reversed. """
+
+        if colourOrder not in self.colourOrders :
+            raise ValueError('Unknown colour order {0}, expected one of {1}'.format(colourOrder, self.colourOrders))
+        if colourOrder == self.colourOrder :
+            return self.imgArray
+        # NB a contiguous copy rather than a reversed-stride view, which OpenCV functions won't accept.
+        return np.ascontiguousarray(self.imgArray[:,:,::-1])
+
+# #####################################################################################################
+
+def dumpLabelInfo(imgFile, labelsResponse, imageContext=None) :
     """ Print out basic info about the image file and the Rekognition labels found in it """
 
-    import matplotlib.image as mpimg 
-    img = mpimg.imread(imgFile)
+    # Only the dimensions of the image are needed. Use the decoded image if we have it, otherwise they can be
+    # read from the image file header without decoding the whole image.
+    if imageContext != None :
+        height, width = imageContext.height, imageContext.width
+    else :
+        height, width = ImageHeaders.getImageDimensions(imgFile)
 
     print('Image file {0}:'.format(imgFile))
     print('File size: {0} bytes'.format(os.path.getsize(imgFile)))
-    print('Image dimensions v x h: {0} x {1}'.format(img.shape[0], img.shape[1]))
+    print('Image dimensions v x h: {0} x {1}'.format(height, width))
     print()
     print('Labels found by Amazon Rekognition:')
     print()
@@ -72,47 +215,134 @@ def dumpLabelInfo(imgFile, labelsResponse) :
 
 # #####################################################################################################
 
+# The 'instances' reported by Rekognition (items with a bounding box) are held in an InstanceTable, a numpy
+# structured array with a row per instance, rather than a dictionary per instance. The pixel offsets for all the
+# bounding boxes are calculated together, and the cropped image of an instance is only sliced out of the main
+# image when it is asked for. This matters for crowd scenes, where there can be hundreds of instances.
+#
+# For code written against the original list-of-dictionaries form, iterating over the table (or indexing it)
+# produces InstanceInfo objects, which behave as read-only dictionaries with the original keys.
+
+class InstanceTable :
+    """ Columnar table of the instances reported by Rekognition in an image, with offsets in pixels """
+
+    rowType = np.dtype([('labelid', 'i4'), ('conf', 'f8'),
+                        ('topoffset', 'i4'), ('leftoffset', 'i4'), ('height', 'i4'), ('width', 'i4'),
+                        ('bottomoffset', 'i4'), ('rightoffset', 'i4')])
+
+    def __init__(self, img, labelsResponse) :
+
+        self.img = img
+        verticalSize, horizontalSize = img.shape[0], img.shape[1]
+
+        # Label names, with each row referring to its label by position in this list.
+        self.labelNames = []
+        labelIDs = []
+        confidences = []
+        boxes = []
+        for label in labelsResponse['Labels'] :
+            instances = label['Instances']
+            if len(instances) == 0 :
+                continue
+            labelID = len(self.labelNames)
+            self.labelNames.append(label['Name'])
+            for instance in instances :
+                box = instance['BoundingBox']
+                labelIDs.append(labelID)
+                confidences.append(instance['Confidence'])
+                boxes.append((box['Top'], box['Left'], box['Height'], box['Width']))
+
+        # Convert the fractional bounding boxes to pixel offsets in one step. NB the conversion to integer
+        # truncates, as int() does.
+        boxes = np.array(boxes, dtype='f8').reshape(-1, 4)
+        scale = np.array([verticalSize, horizontalSize, verticalSize, horizontalSize], dtype='f8')
+        offsets = (boxes * scale).astype('i4')
+
+        self.rows = np.zeros(len(labelIDs), dtype=self.rowType)
+        self.rows['labelid'] = labelIDs
+        self.rows['conf'] = confidences
+        self.rows['topoffset'] = offsets[:,0]
+        self.rows['leftoffset'] = offsets[:,1]
+        self.rows['height'] = offsets[:,2]
+        self.rows['width'] = offsets[:,3]
+        self.rows['bottomoffset'] = offsets[:,0] + offsets[:,2]
+        self.rows['rightoffset'] = offsets[:,1] + offsets[:,3]
+
+    def __len__(self) :
+        return len(self.rows)
+
+    def __getitem__(self, i) :
+        return InstanceInfo(self, i)
+
+    def __iter__(self) :
+        for i in range(len(self.rows)) :
+            yield InstanceInfo(self, i)
+
+    def labelName(self, i) :
+        return self.labelNames[self.rows['labelid'][i]]
+
+    def crop(self, i) :
+        """ Return the part of the image inside the bounding box of instance i (a view, not a copy) """
+        row = self.rows[i]
+        return self.img[row['topoffset']:row['bottomoffset'], row['leftoffset']:row['rightoffset'], :]
+
+    def indicesForLabel(self, labelName) :
+        """ Return the row numbers of the instances with the specified label name """
+        if labelName not in self.labelNames :
+            return np.zeros(0, dtype='i8')
+        return np.flatnonzero(self.rows['labelid'] == self.labelNames.index(labelName))
+
+    def instancesForLabel(self, labelName) :
+        return [ InstanceInfo(self, i) for i in self.indicesForLabel(labelName) ]
+
+class InstanceInfo(Mapping) :
+    """ Read-only dictionary view of one row of an InstanceTable, with the keys used by the original per-instance
+        dictionaries. The crop is only sliced out of the image when the 'crop' key is used. """
+
+    infoKeys = ('labelname', 'conf', 'conf_s', 'height', 'width', 'topoffset', 'bottomoffset', 'leftoffset', 'rightoffset', 'crop')
+
+    def __init__(self, table, i) :
+        self.table = table
+        self.i = int(i)
+
+    def __getitem__(self, key) :
+        if key == 'labelname' :
+            return self.table.labelName(self.i)
+        elif key == 'conf' :
+            return float(self.table.rows['conf'][self.i])
+        elif key == 'conf_s' :
+            return '{0:.1f}'.format(self.table.rows['conf'][self.i])
+        elif key == 'crop' :
+            return self.table.crop(self.i)
+        elif key in self.infoKeys :
+            return int(self.table.rows[key][self.i])
+        raise KeyError(key)
+
+    def __iter__(self) :
+        return iter(self.infoKeys)
+
+    def __len__(self) :
+        return len(self.infoKeys)
+
 def extractInstancesInfo(img, labelsResponse) :
-    """ Extract into a list the basic info about all the 'instances' reported by Rekognition in the image """
-
-    verticalSize, horizontalSize = img.shape[0], img.shape[1]
-    extractions = []
-
-    for label in labelsResponse['Labels']:
-        instances = label['Instances']
-        for instance in instances :
-            info = {}
-            info['labelname'] = label['Name']
-            info['conf'] = instance['Confidence']
-            info['conf_s'] = '{0:.1f}'.format(instance['Confidence'])
-            box = instance['BoundingBox']
-            info['height'] = int(box['Height'] * verticalSize)
-            info['width'] = int(box['Width'] * horizontalSize)
-            info['topoffset'] = int(box['Top'] *verticalSize)
-            info['bottomoffset'] = info['topoffset'] + info['height']
-            info['leftoffset'] = int(box['Left'] * horizontalSize)
-            info['rightoffset'] = info['leftoffset'] + info['width']
-            info['crop'] = img[
-                    info['topoffset']:info['bottomoffset'],
-                    info['leftoffset']:info['rightoffset'],
-                    :]
-            extractions.append(info)
-
-    return extractions
+    """ Extract the basic info about all the 'instances' reported by Rekognition in the image, as an InstanceTable,
+        which can be used as a list of per-instance dictionaries. """
+
+    return InstanceTable(img, labelsResponse)
 
 # #####################################################################################################
 
-def displayImageWithMatPlotLib(imgFile, labelsResponse) :
+def displayImageWithMatPlotLib(imgFile, labelsResponse, imageContext=None) :
     """ Display the image and identified items within it, using the MatPlotLib library """
 
-    import matplotlib.image as mpimg 
-
-    # Read in the image, with MatPlotLib providing a 3-D numpy array
+    # Use the decoded image as a 3-D numpy array, reading it in if the caller hasn't already done so.
     # Dimensions of the numpy array are:
     # - y axis, moving down from the top of the image to the bottom
     # - x axis, moving from the left side of the image to right
     # - colour, as three separate values, for R,G,B
-    img = mpimg.imread(imgFile) 
+    if imageContext == None :
+        imageContext = ImageContext.fromFile(imgFile)
+    img = imageContext.getArray('RGB')
 
     print()
     print('Displaying using MatPlotLib, image type is {0}, shape is {1}'.format(type(img), img.shape))
@@ -175,20 +405,19 @@ def drawMatPlotLib(img, instancesInfo) :
 
 # #####################################################################################################
 
-def displayImageWithPillow(imgFile, labelsResponse) :
+def displayImageWithPillow(imgFile, labelsResponse, imageContext=None) :
     """ Display the image and identified items within it, using the Pillow library """
 
     # https://pillow.readthedocs.io/en/stable/
 
-    from PIL import Image
-
-    img = Image.open(imgFile) 
+    # The image context decodes the file using Pillow, which produces an image object of its own type
+    # (e.g. JpegImageFile), and then a numpy array from that.
+    if imageContext == None :
+        imageContext = ImageContext.fromFile(imgFile)
+    npa = imageContext.getArray('RGB')
 
     print()
-    print('Displaying using Pillow, image type is {0}, size is {1}'.format(type(img), img.size))
-    # Pillow produces an image object which is its own JpegImageFile type.
-    # Produce a numpy array from it as follows:
-    npa = np.array(img)
+    print('Displaying using Pillow, image type is {0}, shape is {1}'.format(type(npa), npa.shape))
     #print(type(npa), npa.shape, img.size)
     #print(npa[0,0,0], npa[0,0,1], npa[0,0,2])
     # The numpy array dimensions are: 
@@ -240,18 +469,17 @@ def drawPillow(img, instancesInfo) :
 
 # #####################################################################################################
 
-def displayImageWithOpenCV(imgFile, labelsResponse) :
+def displayImageWithOpenCV(imgFile, labelsResponse, imageContext=None) :
     """ Display the image and identified items within it, using the OpenCV library """
     
-    from cv2 import cv2     # NB pylint shows warnings about not finding cv2 members if we do
-                            # just 'import cv2' - https://github.com/PyCQA/pylint/issues/2426
-
-    # Read in the image, with MatPlotLib providing a 3-D numpy array
+    # Use the decoded image as a 3-D numpy array, in the colour order OpenCV works with.
     # Dimensions of the numpy array are:
     # - y axis, moving down from the top of the image to the bottom
     # - x axis, moving from the left side of the image to right
     # - colour, as three separate values, for B,G,R - NB the reverse order compared to MatPlotLib
-    img = cv2.imread(imgFile)
+    if imageContext == None :
+        imageContext = ImageContext.fromFile(imgFile)
+    img = imageContext.getArray('BGR')
 
     print()
     print('Displaying using OpenCV, image type is {0}, shape is {1}'.format(type(img), img.shape))
@@ -303,8 +531,92 @@ def drawCV2(img, instancesInfo) :
 
 # #####################################################################################################
 
+# Batch processing
+
+imageFileExtensions = ('.jpg', '.jpeg', '.png')
+
+def findImageFiles(source) :
+    """ Return the list of image files in a directory (and its subdirectories), or listed one per line in a manifest
+        file. Relative paths in a manifest are taken as relative to the manifest's own directory. """
+
+    if os.path.isdir(source) :
+        imgFiles = []
+        for dirPath, _, fileNames in os.walk(source) :
+            imgFiles.extend(os.path.join(dirPath, fileName) for fileName in sorted(fileNames)
+                            if fileName.lower().endswith(imageFileExtensions))
+        return sorted(imgFiles)
+
+    manifestDir = os.path.dirname(source)
+    with open(source, 'r', encoding='utf-8') as f :
+        lines = [ line.strip() for line in f ]
+    return [ os.path.join(manifestDir, line) for line in lines if line != '' and not line.startswith('#') ]
+
+def detectLabelsForFiles(imgFiles, workers=8, maxDimension=None) :
+    """ Detect labels for each of the image files, using a pool of threads sharing one Rekognition client.
+        Returns a list of result dictionaries, one per file, in the order given. """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    # Make sure the shared client (if we need to create it for any cache misses) has a connection pool large
+    # enough for all the threads.
+    global rekognitionClientMaxConnections
+    rekognitionClientMaxConnections = max(rekognitionClientMaxConnections, workers)
+
+    def processFile(imgFile) :
+        result = { 'file' : imgFile, 'labels' : 0, 'instances' : 0, 'error' : None }
+        start = time.perf_counter()
+        try :
+            labelsResponse = detectLabelsFromLocalFile(imgFile, maxDimension=maxDimension)
+            result['labels'] = len(labelsResponse['Labels'])
+            result['instances'] = sum(len(label['Instances']) for label in labelsResponse['Labels'])
+        except Exception as e :
+            result['error'] = str(e)
+        result['seconds'] = time.perf_counter() - start
+        return result
+
+    with ThreadPoolExecutor(max_workers=workers) as executor :
+        return list(executor.map(processFile, imgFiles))
+
+def printBatchSummary(results, elapsedSeconds, workers) :
+    """ Print a table of the results of a batch run, with overall throughput """
+
+    print()
+    print('{0:50.50s} {1:>7s} {2:>10s} {3:>9s}  {4}'.format('Image file', 'Labels', 'Instances', 'Seconds', 'Error'))
+    for result in results :
+        print('{0:50.50s} {1:7d} {2:10d} {3:9.2f}  {4}'.format(os.path.basename(result['file']), result['labels'],
+                result['instances'], result['seconds'], result['error'] or ''))
+    print()
+
+    failures = sum(1 for result in results if result['error'] != None)
+    rate = len(results) / elapsedSeconds if elapsedSeconds > 0 else 0.0
+    print('{0} images ({1} failed) processed in {2:.1f}s using {3} threads : {4:.2f} images per second'.format(
+            len(results), failures, elapsedSeconds, workers, rate))
+    print(Cacher.Cacher.stats.summary())
+
+def batchMain(source, workers, maxDimension=None) :
+
+    if not os.path.exists(source) :
+        print()
+        print('*** Directory or manifest file {0} not found'.format(source))
+        return
+
+    imgFiles = findImageFiles(source)
+    print('Detecting labels for {0} image files from {1} using {2} threads'.format(len(imgFiles), source, workers))
+
+    start = time.perf_counter()
+    results = detectLabelsForFiles(imgFiles, workers, maxDimension)
+    printBatchSummary(results, time.perf_counter() - start, workers)
+
+# #####################################################################################################
+
 def main(argv) :
 
+    if len(argv) > 2 and argv[1] == '--batch' :
+        workers = int(argv[3]) if len(argv) > 3 else 8
+        maxDimension = int(argv[4]) if len(argv) > 4 else None
+        batchMain(argv[2], workers, maxDimension)
+        return
+
     if len(argv) > 1 and argv[1] != '-' :
         imgFile = argv[1]
     else :
@@ -6,11 +6,13 @@
 #   found by Rekognition
 # - and then the instance rectangles are displayed one-by-one, with a confidence score
 #
-# See the RekognitionTrial1 module for detailed Rekognition interaction.
+# See the RekognitionTrial1 module for detailed Rekognition interaction, and for the packages which need to
+# be installed (Pillow, matplotlib, opencv-python, numpy, boto3).
 #
 # Image manipulation is performed using a combination of tools(!):
-# - Matplotlib, to read the original image into an RGB numpy array, and saving the final
-#   image to an output file 
+# - Pillow, to read the original image into an RGB numpy array (once, held in an rt1.ImageContext
+#   object which is passed to each processing stage)
+# - Matplotlib, for saving the final image to an output file 
 # - Pillow, to convert text strings to image form
 # - CV2 for drawing rectangles and displaying intermediate images
 # - and some direct numpy array manipulation (to copy images onto other images)
@@ -23,14 +25,35 @@
 #
 # When using Pillow, these arrays have to be converted to a Pillow image object.
 # When using CV2, allowance needs to be made for CV2 treating the colour values as being BGR instead of RGB.
+#
+# For very large output images (e.g. panoramas with many instances), the output can be written as a PNG file
+# in horizontal strips of the specified height, so that the whole output image is never held in memory. The
+# extracted images are only produced as the strips reach them, so memory use is bounded by the source image,
+# one strip, and the blocks overlapping the current strip (at most the rectangles copy of the source image, or
+# one row of extracted images), however large the output image is:
+#
+#   python RekognitionTrial2.py <image file> <output file> <strip height>
+#
+# The extracted images for each label are packed into rows in one of several ways (see rowPackings below),
+# chosen with a further argument ('-' for the strip height writes the output in one go as usual):
+#
+#   python RekognitionTrial2.py <image file> <output file> <strip height or -> <greedy|shelf|firstfit>
+#
+# Can also be run in batch mode, to produce an output image for each image in a directory (or listed in a
+# manifest file), rendering them in parallel using a pool of processes:
+#
+#   python RekognitionTrial2.py --batch <directory or manifest file> <output directory> [<number of processes> [<max images in progress>]]
 
 # #####################################################################################################
 
 import sys
 import os
+import functools
+import time
 
 import numpy as np
 
+import Cacher
 import RekognitionTrial1 as rt1
 
 # #####################################################################################################
@@ -38,19 +61,58 @@ import RekognitionTrial1 as rt1
 def readImageArrayFromFile(imgFile) :
     """ Read the source image file into a 3-D numpy array [y,x,RGB] """
 
-    import matplotlib.image as mpimg 
-    imgArray = mpimg.imread(imgFile)
-
-    # Matplotlib produces the numpy array in the correct format. No need to modify it.
-    return imgArray
+    return rt1.ImageContext.fromFile(imgFile).getArray('RGB')
 
-def writeImageArrayToFile(filename, imgArray) :
+def writeImageArrayToFile(filename, imgArray, colourOrder='RGB') :
     """ Write an image array out to a jpg file """
 
+    # Matplotlib expects the colour values in RGB order.
+    if colourOrder == 'BGR' :
+        imgArray = convertToBGR(imgArray)
     import matplotlib.image as mpimg 
     mpimg.imsave(filename, imgArray, format='jpg')
     print('Image file saved: {0}'.format(filename))
 
+# Write an image as a PNG file a horizontal strip at a time, as the strips are produced, so that only one strip
+# needs to be in memory. Uses zlib directly to compress the image data rather than an image library, as the
+# libraries expect the whole image to be passed to them at once.
+# https://www.w3.org/TR/PNG/
+
+def writeImageStripsToPNGFile(filename, height, width, strips, compressionLevel=6) :
+    """ Write a PNG file of the specified size from an iterable of [y,x,RGB] strips, top to bottom """
+
+    import struct
+    import zlib
+
+    def writeChunk(f, chunkType, data) :
+        f.write(struct.pack('>I', len(data)))
+        f.write(chunkType)
+        f.write(data)
+        f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunkType)) & 0xFFFFFFFF))
+
+    with open(filename, 'wb') as f :
+        f.write(b'\x89PNG\r\n\x1a\n')
+        # 8-bit RGB, no interlacing
+        writeChunk(f, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
+
+        compressor = zlib.compressobj(compressionLevel)
+        for strip in strips :
+            # Each row of pixels starts with a filter type byte. Use the 'Sub' filter (1), which stores each
+            # byte as the difference from the same colour value of the pixel to its left (modulo 256), as this
+            # usually compresses photos better.
+            pixels = strip.reshape(strip.shape[0], width*3)
+            rows = np.empty((strip.shape[0], 1 + width*3), dtype='uint8')
+            rows[:,0] = 1
+            rows[:,1:4] = pixels[:,0:3]
+            rows[:,4:] = pixels[:,3:] - pixels[:,:-3]
+            data = compressor.compress(rows.tobytes())
+            if len(data) > 0 :
+                writeChunk(f, b'IDAT', data)
+        writeChunk(f, b'IDAT', compressor.flush())
+        writeChunk(f, b'IEND', b'')
+
+    print('Image file saved: {0}'.format(filename))
+
 # Alternative write-image-to-file function using CV2 - works, but not used
 def writeImageArrayToFileUsingCV2(filename, imgArray) :
 
@@ -72,7 +134,7 @@ def showImage(title, imgArray) :
 
 # #####################################################################################################
 
-def getSummaryText(imgFile, labelsResponse) :
+def getSummaryText(imgFile, labelsResponse, imageContext=None) :
     """ Return multiline summary text about the image and the items in Rekognition's label response """
 
     # The rt1 module has a function which produces the text we want, but prints it to stdout instead 
@@ -83,7 +145,7 @@ def getSummaryText(imgFile, labelsResponse) :
     tempStdOut = StringIO()
     savedStdOut = sys.stdout
     sys.stdout = tempStdOut
-    rt1.dumpLabelInfo(imgFile, labelsResponse)
+    rt1.dumpLabelInfo(imgFile, labelsResponse, imageContext)
     sys.stdout = savedStdOut
 
     return tempStdOut.getvalue()
@@ -127,18 +189,97 @@ def addImageAt(imgArray, imgArrayToAdd, ytop, xleft) :
     imgArray[ytop:ybottom, xleft:xright] = imgArrayToAdd[:,:]
     return imgArray
 
+# Building up an output image by repeatedly adding to it with addImageAt means copying the whole image each
+# time it has to be extended. For the composite output image, a CanvasLayout is used instead, in two passes:
+# - first, each block (image array) is measured and given its position, with the overall size of the canvas
+#   growing to fit it
+# - then, the canvas is allocated once at its final size, and each block copied into its place.
+#
+# A block can also be 'lazy': a function producing the image array, along with the size it will have. The
+# function is only called when the canvas is rendered, and the array it returns is dropped once it has been
+# copied to the canvas (or, when rendering in strips, once the last strip it overlaps has been produced). So
+# only the blocks currently being copied need to be held in memory, rather than every block in the layout.
+
+class CanvasLayout :
+    """ Two-pass layout of image blocks onto a single white canvas """
+
+    def __init__(self) :
+        self.blocks = []        # (image array or function returning one, ytop, xleft, height, width)
+        self.height = 0
+        self.width = 0
+
+    def addBlock(self, imgArray, ytop, xleft) :
+        """ Place an image with its top left corner at the specified position """
+        self.addLazyBlock(imgArray, imgArray.shape[0], imgArray.shape[1], ytop, xleft)
+
+    def addLazyBlock(self, source, height, width, ytop, xleft) :
+        """ Place an image of the specified size, where source is either the image array or a function which
+            returns it, called when the canvas is rendered """
+        self.blocks.append((source, ytop, xleft, height, width))
+        self.height = max(self.height, ytop + height)
+        self.width = max(self.width, xleft + width)
+
+    def addBelow(self, imgArray, xleft) :
+        """ Place an image below everything placed so far """
+        self.addBlock(imgArray, self.height, xleft)
+
+    def addLayoutBelow(self, other, xleft) :
+        """ Place the blocks of another layout below everything placed so far, keeping their relative positions """
+        ytop = self.height
+        for (source, blockTop, blockLeft, height, width) in other.blocks :
+            self.addLazyBlock(source, height, width, ytop + blockTop, xleft + blockLeft)
+        self.height = max(self.height, ytop + other.height)
+        self.width = max(self.width, xleft + other.width)
+
+    def addSpace(self, height, width=0) :
+        """ Add white space below everything placed so far, and make sure the canvas is at least the given width """
+        self.height += height
+        self.width = max(self.width, width)
+
+    def coveredArea(self) :
+        """ Return the total area of the blocks, assuming they don't overlap """
+        return sum(height * width for (_, _, _, height, width) in self.blocks)
+
+    def render(self) :
+        """ Allocate the canvas at its final size and copy each block into place """
+        imgArray = newImageArray(self.height, self.width)
+        for (source, ytop, xleft, height, width) in self.blocks :
+            imgArray[ytop:ytop+height, xleft:xleft+width] = source() if callable(source) else source
+        return imgArray
+
+    def renderStrips(self, stripHeight) :
+        """ Generate the canvas as a series of horizontal strips, top to bottom, without allocating the whole canvas """
+        rendered = {}       # Lazy blocks produced for an earlier strip which also overlap later ones, by block number
+        for stripTop in range(0, self.height, stripHeight) :
+            stripBottom = min(stripTop + stripHeight, self.height)
+            strip = newImageArray(stripBottom - stripTop, self.width)
+            # Copy in the part of each block which overlaps the strip.
+            for n, (source, ytop, xleft, height, width) in enumerate(self.blocks) :
+                overlapTop = max(ytop, stripTop)
+                overlapBottom = min(ytop + height, stripBottom)
+                if overlapTop < overlapBottom :
+                    if callable(source) :
+                        imgArrayToAdd = rendered.pop(n) if n in rendered else source()
+                        if ytop + height > stripBottom :
+                            rendered[n] = imgArrayToAdd
+                    else :
+                        imgArrayToAdd = source
+                    strip[overlapTop-stripTop:overlapBottom-stripTop, xleft:xleft+width] = \
+                        imgArrayToAdd[overlapTop-ytop:overlapBottom-ytop]
+            yield strip
+
 def convertToBGR(imgArray) :
     """ Converts a 3-D [y,x,RGB] numpy array to [y,x,BGR] format, (for use with CV2) """
     return imgArray[:,:,::-1]
 
 # #####################################################################################################
 
-def addRectanglesToImage(imgArray, instanceInfo, RGBColourMap) :
+def addRectanglesToImage(imgArray, instanceInfo, RGBColourMap, colourOrder='RGB') :
     """ Use 'instance info' obtained from Rekognition to draw rectangles in the specified colour around 
         the labelled instances located in the main image. """
 
-    # Use CV2 for this. NB We specify colours as RGB, as that is what we're using for the array. But if we
-    # ever used CV2's colours, they would be BGR and so need reversing to match the rest of the array.
+    # Use CV2 for this. NB We specify colours as RGB, as that is what we normally use for the array. If
+    # the array is in CV2's BGR order, the colours are reversed to match.
     from cv2 import cv2
 
     # Potential CV2 aLpha handling if ever required
@@ -149,34 +290,67 @@ def addRectanglesToImage(imgArray, instanceInfo, RGBColourMap) :
 
     for info in instanceInfo :        
         RGBColour = RGBColourMap.get(info['labelname'], unknownLabelColour)
-        cv2.rectangle(imgArray, (info['leftoffset'], info['topoffset'], info['width'], info['height']), color=RGBColour, thickness=2 )
+        colour = RGBColour[::-1] if colourOrder == 'BGR' else RGBColour
+        cv2.rectangle(imgArray, (info['leftoffset'], info['topoffset'], info['width'], info['height']), color=colour, thickness=2 )
 
     return imgArray
 
 # #####################################################################################################
 
+# Text images are produced hundreds of times for busy images (a heading per label, and a confidence score per
+# instance), often for the same strings. So fonts are only loaded from their font files once, and each short text
+# image is only rendered once per process for a given text, font and margins. Long texts (such as the per-image
+# summary) are unlikely to repeat and would make the cache large, so aren't cached. Text images are marked
+# read-only, as cached ones are shared: callers copy them into other images rather than drawing on them.
+
+textCacheMaxLength = 200        # Longest text to cache the image of
+
+@functools.lru_cache(maxsize=None)
+def getFont(fontFile, fontPointSize) :
+    """ Return a Pillow font object, loaded from the font file the first time it is needed """
+
+    from PIL import ImageFont
+    return ImageFont.truetype(fontFile, fontPointSize)
+
+@functools.lru_cache(maxsize=None)
+def getMeasuringDraw() :
+    """ Return a Pillow 'Draw' object to measure text with """
+
+    # We need a Pillow 'Draw' object to perform text operations with. To determine the size, 
+    # we still need to give it an 'image' to work with - use a dummy one.
+    from PIL import Image, ImageDraw
+    pilImage = Image.fromarray(newImageArray(100,100), 'RGB')
+    return ImageDraw.Draw(pilImage, mode='RGBA')
+
 def getTextAsImageArray(text, fontFile="cour.ttf", fontPointSize=25, ymargin=10, xmargin=10) :
-    """ Return a 3-D [y,x,RGB] numpy image array which displays the specified text, black text on white.
+    """ Return a (read-only) 3-D [y,x,RGB] numpy image array which displays the specified text, black text on white.
 
         - this uses Pillow
         - on Windows, the available font file names are in C:/Windows/Fonts
     """
 
+    if len(text) <= textCacheMaxLength :
+        return renderTextCached(text, fontFile, fontPointSize, ymargin, xmargin)
+    else :
+        return renderText(text, fontFile, fontPointSize, ymargin, xmargin)
+
+@functools.lru_cache(maxsize=4096)
+def renderTextCached(text, fontFile, fontPointSize, ymargin, xmargin) :
+    return renderText(text, fontFile, fontPointSize, ymargin, xmargin)
+
+def renderText(text, fontFile, fontPointSize, ymargin, xmargin) :
+    """ Produce the text image for getTextAsImageArray """
+
     # Do this in stages:
     # - get Pillow to tell us how big the image will need to be
     # - create an image array large enough
     # - get Pillow to write the text to the new image array.
 
     # https://pillow.readthedocs.io/en/stable/reference/ImageDraw.html
-    from PIL import Image, ImageDraw, ImageFont
-
-    font = ImageFont.truetype(fontFile, fontPointSize)
+    from PIL import Image, ImageDraw
 
-    # We need a Pillow 'Draw' object to perform text operations with. To determine the size, 
-    # we still need to give it an 'image' to work with - use a dummy one.
-    dummyImageArray = newImageArray(100,100)
-    pilImage = Image.fromarray(dummyImageArray.astype('uint8'), 'RGB')
-    draw = ImageDraw.Draw(pilImage, mode='RGBA')
+    font = getFont(fontFile, fontPointSize)
+    draw = getMeasuringDraw()
 
     spacing = 2         # Number of pixels between lines
     strokeWidth = 0     # Thinnest line for writing the text
@@ -209,6 +383,7 @@ def getTextAsImageArray(text, fontFile="cour.ttf", fontPointSize=25, ymargin=10,
     # are items detected by Rekognition.
     # showImage('PillowText', npa)   
 
+    npa.setflags(write=False)
     return npa
 
 # #####################################################################################################
@@ -265,176 +440,333 @@ RGBColourMap = {
 
 # #####################################################################################################
 
+def getConfidenceTextArray(confidenceText) :
+    """ Return the image of the confidence score text shown below an extracted image """
+    return getTextAsImageArray(confidenceText, fontPointSize=20, xmargin=0)
+
 def addConfidenceScore(imgArraySource, confidenceText) :
     """ Add text in a bar added to the bottom of an image to show the confidence score and return 
         the new image. """
 
-    # Work on a copy the original image.
-    imgArray = imgArraySource.copy()
-
     # Generate an image containing the confidence text.
-    textArray = getTextAsImageArray(confidenceText, fontPointSize=20, xmargin=0)
-    # print('Adding conf to {0} {1} - {2}'.format(imgArray.shape, confidenceText, textArray.shape))
+    textArray = getConfidenceTextArray(confidenceText)
+    # print('Adding conf to {0} {1} - {2}'.format(imgArraySource.shape, confidenceText, textArray.shape))
 
-    # Add the text array at the bottom of the image, centred if the text array width is 
+    # Add the text array at the bottom of (a copy of) the image, centred if the text array width is 
     # smaller than the width of the image.
-    if textArray.shape[1] < imgArray.shape[1] :
-        leftOffset = (imgArray.shape[1] - textArray.shape[1]) // 2
+    if textArray.shape[1] < imgArraySource.shape[1] :
+        leftOffset = (imgArraySource.shape[1] - textArray.shape[1]) // 2
     else :
         leftOffset = 0
-    imgArray = addImageAt(imgArray, textArray, imgArray.shape[0], leftOffset)
+    layout = CanvasLayout()
+    layout.addBlock(imgArraySource, 0, 0)
+    layout.addBelow(textArray, leftOffset)
 
-    return imgArray
+    return layout.render()
 
 # #####################################################################################################
 
-def generateRowImageArray(rowImages, horizontalSpacing) :
-    """ Places the images into a single row image, with the specified spacing. """
+def generateRowLayout(rowBlocks, horizontalSpacing) :
+    """ Places the (lazy) blocks, each a (function, height, width) tuple, into a single row layout, with the
+        specified spacing. """
 
-    # Work out the height that the combined image needs to be
-    rowHeight = max([image.shape[0] for image in rowImages])
-
-    # Initial array dimensions don't really matter (as long as not too large), we will extend as we
-    # go along.
-    rowImage = newImageArray(rowHeight, horizontalSpacing)
+    # The row is at least the width of the spacing, even for a single narrow image.
+    layout = CanvasLayout()
+    layout.addSpace(0, horizontalSpacing)
     horizontalOffset = 0
-    for image in rowImages :
-        rowImage = addImageAt(rowImage, image, 0, horizontalOffset)
-        #rowImage = addImageAt(rowImage, image, rowHeight - image.shape[0], horizontalOffset)
-        horizontalOffset += horizontalSpacing + image.shape[1]
+    for (render, height, width) in rowBlocks :
+        layout.addLazyBlock(render, height, width, 0, horizontalOffset)
+        horizontalOffset += horizontalSpacing + width
     
-    return rowImage
+    return layout
+
+# The extracted images for a label are packed into rows no wider than the main image. Different ways of packing
+# them can be chosen:
+# - 'greedy'   : in the order Rekognition reported them, starting a new row when the next image doesn't fit
+# - 'shelf'    : the same, but sorted tallest first, so that images of similar height share a row, and less
+#                space is wasted below the shorter images in each row
+# - 'firstfit' : sorted tallest first, with each image put into the first row with room for it, which also
+#                fills up gaps left at the ends of earlier rows
+rowPackings = ('greedy', 'shelf', 'firstfit')
+
+def packRows(widths, heights, maxRowWidth, horizontalSpacing, packing='greedy') :
+    """ Pack items of the specified widths and heights into rows, returning a list of rows, each a list of item
+        indices. Each row has at least one item in it, even if that item is wider than the maximum row width. """
+
+    if packing not in rowPackings :
+        raise ValueError('Unknown row packing {0}, expected one of {1}'.format(packing, rowPackings))
 
-def layoutExtractedImages(instances, maxRowWidth, horizontalSpacing) :
-    """ Lays out the set of instances in rows, returning a list of rows. """
+    order = list(range(len(widths)))
+    if packing != 'greedy' :
+        order.sort(key=lambda i : heights[i], reverse=True)
 
-    # Return the set of rows found as a list.
     rows = []
+    rowWidths = []
+    for i in order :
+        # Find a row that the item will fit into: only the latest row, except for first-fit.
+        candidateRows = range(len(rows)) if packing == 'firstfit' else range(len(rows)-1, len(rows))
+        targetRow = None
+        for r in candidateRows :
+            if r >= 0 and rowWidths[r] + horizontalSpacing + widths[i] <= maxRowWidth :
+                targetRow = r
+                break
+        if targetRow == None :
+            rows.append([i])
+            rowWidths.append(widths[i])
+        else :
+            rows[targetRow].append(i)
+            rowWidths[targetRow] += horizontalSpacing + widths[i]
+
+    return rows
+
+def layoutExtractedImages(instances, maxRowWidth, horizontalSpacing, packing='greedy', usage=None) :
+    """ Lays out the set of instances in rows, returning a list of rows, each a CanvasLayout. The image of each
+        instance with its confidence score is only produced when the row is rendered. If a usage dictionary is
+        passed in, the total area of the instance images and of the rows holding them is added to it, to show how
+        much of the row area is wasted. """
 
-    # Build up the set of images to display on each row in turn, until the row width
-    # has been used up, then start a new row.
-    rowImages = []
-    rowWidth = 0
+    # Each instance is shown as its cropped image with the confidence score text below it (see
+    # addConfidenceScore). Work out the size of each of these from the crop (a view of the source image)
+    # and the (small, cached) text image, without producing the combined image yet.
+    blocks = []
     for instance in instances :
-        # Add confidence score text below each cropped image
-        imgCroppedArray = addConfidenceScore(instance['crop'], instance['conf_s'])
-        imgWidth = imgCroppedArray.shape[1]
-        # Will this instance fit into the current row ? Always put at least one item in.
-        if len(rowImages) == 0:
-            rowImages.append(imgCroppedArray)
-            rowWidth = imgWidth
-        elif rowWidth + horizontalSpacing + imgWidth <= maxRowWidth :
-            rowImages.append(imgCroppedArray)
-            rowWidth += horizontalSpacing + imgWidth
-        else :
-            # No more for this row. Create an overall image for the items in the row.
-            rows.append(generateRowImageArray(rowImages, horizontalSpacing))
-            # Put the current item at the start of a new row.
-            rowImages.clear()
-            rowImages.append(imgCroppedArray)
-            rowWidth = imgWidth
+        crop = instance['crop']
+        textArray = getConfidenceTextArray(instance['conf_s'])
+        blocks.append((functools.partial(addConfidenceScore, crop, instance['conf_s']),
+                       crop.shape[0] + textArray.shape[0], max(crop.shape[1], textArray.shape[1])))
+
+    rowIndices = packRows([ width for (_, _, width) in blocks ], [ height for (_, height, _) in blocks ],
+                          maxRowWidth, horizontalSpacing, packing)
 
-    # Deal with the final row.
-    if len(rowImages) > 0 :
-        rows.append(generateRowImageArray(rowImages, horizontalSpacing))
+    # Create a layout for the items in each row, returning the set of rows found as a list.
+    rows = [ generateRowLayout([ blocks[i] for i in indices ], horizontalSpacing) for indices in rowIndices ]
+
+    if usage != None :
+        usage['imageArea'] = usage.get('imageArea', 0) + sum(height * width for (_, height, width) in blocks)
+        usage['rowArea'] = usage.get('rowArea', 0) + sum(row.height * row.width for row in rows)
+        usage['rows'] = usage.get('rows', 0) + len(rows)
 
     return rows
 
 # #####################################################################################################
 
-def performLabelExtraction(imgFile) :
+def performLabelExtraction(imgFile, imageContext=None) :
     """ Invoke Rekognition on the image, return the response info and a text summary """
 
     # Use functions in the rt1 module to interact with Rekognition (including accessing local cache of
     # results if available.)
     labelsResponse = rt1.detectLabelsFromLocalFile(imgFile)
-    summaryText = getSummaryText(imgFile, labelsResponse) 
+    summaryText = getSummaryText(imgFile, labelsResponse, imageContext) 
     summaryText = summaryText.rstrip()  # Remove trailing whitespace, especially newlines
     return labelsResponse, summaryText
 
 # #####################################################################################################
 
-def produceOutputImage(imgFile, labelsResponse, summaryText, outputFileName) :
-    """ Does all the processing of the source image and Rekognition label data to produce the output image """
+def produceOutputImage(imgFile, labelsResponse, summaryText, outputFileName, imageContext=None, stripHeight=None, packing='greedy') :
+    """ Does all the processing of the source image and Rekognition label data to produce the output image. If
+        stripHeight is specified, the output is written as a PNG file in strips of that height. The packing
+        argument selects how extracted images are packed into rows (see rowPackings). """
 
-    # Get the image we're processing into a 3-D numpy array [y,x,RGB]
-    imgSourceArray = readImageArrayFromFile(imgFile)
+    # Get the image we're processing as a 3-D numpy array [y,x,RGB], decoding the file if the caller hasn't
+    # already done so.
+    if imageContext == None :
+        imageContext = rt1.ImageContext.fromFile(imgFile)
+    imgSourceArray = imageContext.getArray('RGB')
     sourceShape = imgSourceArray.shape
 
     # print()
     # print('Image array type is {0}, shape is {1}'.format(type(imgSourceArray), sourceShape))
 
-    # Set up an all-white image array to use as a vertical spacing element at various points
+    # The output image is built up as a CanvasLayout, placing each block below the previous ones, and is
+    # only produced as a single image array at the end. Vertical spacing is just white space added to the layout.
     horizontalMargin = 100
     verticalMargin = 50
-    verticalSpacingArray = newImageArray(verticalMargin, sourceShape[1]+2*horizontalMargin)
+    spacingWidth = sourceShape[1]+2*horizontalMargin
 
-    # Use the 'imgTargetArray' variable to reference the array for output image being built up.
+    layout = CanvasLayout()
 
     # Start by putting a margin at the top
-    imgTargetArray = verticalSpacingArray.copy()      
+    layout.addSpace(verticalMargin, spacingWidth)
 
     # Add the source image, and a vertical spacing element
-    imgTargetArray = addImageAt(imgTargetArray, imgSourceArray, imgTargetArray.shape[0], horizontalMargin)
-    imgTargetArray = addImageAt(imgTargetArray, verticalSpacingArray, imgTargetArray.shape[0], 0)
-
-    # showImage(imgFile, imgTargetArray)
+    layout.addBelow(imgSourceArray, horizontalMargin)
+    layout.addSpace(verticalMargin, spacingWidth)
 
     # Now move onto the Rekognition data
-    # Reformat the data a little
+    # Reformat the data a little, into a table of instances with pixel offsets.
     instancesInfo = rt1.extractInstancesInfo(imgSourceArray, labelsResponse)
 
     # Put the multi-line text summarising the Rekognition labels detected into image form.
     textArray = getTextAsImageArray(summaryText)    
 
-    # Add whitespace margin to the right of the text array if it is wider than the main image.
+    # Add the image-ised text to the bottom for the output image, and a vertical spacing element. Leave a
+    # whitespace margin to the right of the text if it is wider than the main image.
+    layout.addBelow(textArray, horizontalMargin)
     if textArray.shape[1] > sourceShape[1] :
-        textArray = extendImage(textArray, textArray.shape[0], textArray.shape[1] + horizontalMargin)
-
-    # Add the image-ised text to the bottom for the output image, and a vertical spacing element
-    imgTargetArray = addImageAt(imgTargetArray, textArray, imgTargetArray.shape[0], horizontalMargin)
-    imgTargetArray = addImageAt(imgTargetArray, verticalSpacingArray, imgTargetArray.shape[0], 0)
-
-    # showImage(imgFile, imgTargetArray)
+        layout.addSpace(0, horizontalMargin + textArray.shape[1] + horizontalMargin)
+    layout.addSpace(verticalMargin, spacingWidth)
 
     # If Rekognition detected any labelled items in the source image, add another copy of the source image, 
-    # this time with coloured rectangles drawn on it to show where the labelled items are.
+    # this time with coloured rectangles drawn on it to show where the labelled items are. The copy is only
+    # made when this part of the output is rendered.
     if len(instancesInfo) > 0 :
-        imgWithRectangles = addRectanglesToImage(imgSourceArray.copy(), instancesInfo, RGBColourMap)
-        imgTargetArray = addImageAt(imgTargetArray, imgWithRectangles, imgTargetArray.shape[0], horizontalMargin)
+        drawRectangles = lambda : addRectanglesToImage(imgSourceArray.copy(), instancesInfo, RGBColourMap)
+        layout.addLazyBlock(drawRectangles, sourceShape[0], sourceShape[1], layout.height, horizontalMargin)
 
     # And now add the individual extracted images (showing confidence values) grouped by label type,
     # with multiple images per row.
+    usage = {}
     if len(instancesInfo) > 0 :
-        # Use reduced vertical spacing element between items here.
-        verticalRowSpacingArray = newImageArray(verticalMargin // 2, imgTargetArray.shape[1])
-
         # Go through each distinct label type in turn
-        labelNames = sorted(set(instance['labelname'] for instance in instancesInfo), reverse=False)
+        labelNames = sorted(instancesInfo.labelNames, reverse=False)
         for labelName in labelNames :
             # Add the label name text as a section heading
             imgLabelName = getTextAsImageArray('Label = "{0}"'.format(labelName))
-            imgTargetArray = addImageAt(imgTargetArray, verticalSpacingArray, imgTargetArray.shape[0], 0)
-            imgTargetArray = addImageAt(imgTargetArray, imgLabelName, imgTargetArray.shape[0], horizontalMargin)
+            layout.addSpace(verticalMargin)
+            layout.addBelow(imgLabelName, horizontalMargin)
+
+            # Display images with this label name, spaced out into multiple rows if necessary. Use reduced 
+            # vertical spacing between rows here.
+            # Rows of images can use the width of the layout so far, apart from the margins.
+            instances = instancesInfo.instancesForLabel(labelName)
+            availableWidth = layout.width - 2*horizontalMargin
+            rowsOfImages = layoutExtractedImages(instances, availableWidth, horizontalMargin, packing, usage)
+            for rowOfImages in rowsOfImages :
+                layout.addSpace(verticalMargin // 2)
+                layout.addLayoutBelow(rowOfImages, horizontalMargin)
+
+    # Add a final spacing element at the bottom, produce the final image and write it to a file.
+    layout.addSpace(verticalMargin, spacingWidth)
+    # Report how well the extracted images were packed into rows, and the overall output size.
+    if usage.get('rowArea', 0) > 0 :
+        print('Extracted images packed into {0} rows ({1}): images use {2:.1f}% of the row area'.format(
+                usage['rows'], packing, 100 * usage['imageArea'] / usage['rowArea']))
+    print('Output image is {0} x {1} ({2:.1f} megapixels), {3:.1f}% covered by images'.format(
+            layout.height, layout.width, layout.height * layout.width / 1e6,
+            100 * layout.coveredArea() / (layout.height * layout.width)))
+
+    if stripHeight == None :
+        imgTargetArray = layout.render()
+        writeImageArrayToFile(outputFileName, imgTargetArray)
+    else :
+        writeImageStripsToPNGFile(outputFileName, layout.height, layout.width, layout.renderStrips(stripHeight))
 
-            # Display images with this label name, spaced out into multiple rows if necessary.
-            instances = [ instance for instance in instancesInfo if instance['labelname'] == labelName ]
-            availableWidth = imgTargetArray.shape[1] - 2*horizontalMargin
-            rowsOfImages = layoutExtractedImages(instances, availableWidth, horizontalMargin)
-            for imgOfRowOfImages in rowsOfImages :
-                imgTargetArray = addImageAt(imgTargetArray, verticalRowSpacingArray, imgTargetArray.shape[0], 0)
-                imgTargetArray = addImageAt(imgTargetArray, imgOfRowOfImages, imgTargetArray.shape[0], horizontalMargin)
+    return
 
-    # Add a final spacing element at the bottom, and write the final image to a file.
-    imgTargetArray = addImageAt(imgTargetArray, verticalSpacingArray, imgTargetArray.shape[0], 0)
-    writeImageArrayToFile(outputFileName, imgTargetArray)
+# #####################################################################################################
 
-    return
+# Batch processing
+
+# Producing the output image is CPU-bound (cropping, text rendering, rectangle drawing, JPEG encoding), so in
+# batch mode each image is processed in a separate process, with a process per CPU core by default. Each
+# process writes its output file as soon as the image is done. The number of images submitted to the pool
+# at any one time is limited, to keep memory use bounded however many images there are.
+
+def outputFileNamesFor(imgFiles, outputDir) :
+    """ Return a list of output file names, one per image file, adding a number if image files in different
+        directories have the same name. """
+
+    outputFileNames = []
+    used = set()
+    for imgFile in imgFiles :
+        baseName = os.path.splitext(os.path.basename(imgFile))[0]
+        outputFileName = os.path.join(outputDir, baseName + '_rekognition_output.jpg')
+        n = 1
+        while outputFileName in used :
+            n += 1
+            outputFileName = os.path.join(outputDir, '{0}_{1}_rekognition_output.jpg'.format(baseName, n))
+        used.add(outputFileName)
+        outputFileNames.append(outputFileName)
+    return outputFileNames
+
+def processImageFile(imgFile, outputFileName) :
+    """ Produce the output image for one image file, for use in a worker process. Returns a result dictionary. """
+
+    result = { 'file' : imgFile, 'output' : outputFileName, 'labels' : 0, 'instances' : 0, 'error' : None }
+    start = time.perf_counter()
+    try :
+        imageContext = rt1.ImageContext.fromFile(imgFile)
+        (labelsResponse, summaryText) = performLabelExtraction(imgFile, imageContext)
+        produceOutputImage(imgFile, labelsResponse, summaryText, outputFileName, imageContext)
+        result['labels'] = len(labelsResponse['Labels'])
+        result['instances'] = sum(len(label['Instances']) for label in labelsResponse['Labels'])
+    except Exception as e :
+        result['error'] = str(e)
+    # Exit handlers don't run in pool worker processes, so make sure cache writes which are done in the background,
+    # or held back to write in batches, are done.
+    Cacher.Cacher.flush()
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+def initWorkerProcess() :
+    """ Set up a worker process in the pool """
+
+    # Exit handlers don't run in pool worker processes, so have the cache finish off (e.g. write its metrics
+    # summary) when the worker process exits.
+    import multiprocessing.util
+    multiprocessing.util.Finalize(None, Cacher.Cacher.close, exitpriority=10)
+
+def processImageFiles(imgFiles, outputDir, processes=None, maxInProgress=None) :
+    """ Produce output images for the image files using a pool of processes, with at most maxInProgress images
+        submitted to the pool at once. Returns a list of result dictionaries, in order of completion. """
+
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+    if processes == None :
+        processes = os.cpu_count() or 1
+    if maxInProgress == None :
+        maxInProgress = 2 * processes       # Enough to keep every process busy
+
+    results = []
+    pending = list(zip(imgFiles, outputFileNamesFor(imgFiles, outputDir)))
+    pending.reverse()       # So we can pop them off the end in order
+    inProgress = set()
+    with ProcessPoolExecutor(max_workers=processes, initializer=initWorkerProcess) as executor :
+        while len(pending) > 0 or len(inProgress) > 0 :
+            while len(pending) > 0 and len(inProgress) < maxInProgress :
+                (imgFile, outputFileName) = pending.pop()
+                inProgress.add(executor.submit(processImageFile, imgFile, outputFileName))
+            done, inProgress = wait(inProgress, return_when=FIRST_COMPLETED)
+            for future in done :
+                result = future.result()
+                results.append(result)
+                print('{0:4d}/{1} {2} : {3}'.format(len(results), len(imgFiles), os.path.basename(result['file']),
+                        result['error'] if result['error'] != None else 'written to ' + result['output']))
+    return results
+
+def batchMain(source, outputDir, processes=None, maxInProgress=None) :
+
+    if not os.path.exists(source) :
+        print()
+        print('*** Directory or manifest file {0} not found'.format(source))
+        return
+
+    os.makedirs(outputDir, exist_ok=True)
+    imgFiles = rt1.findImageFiles(source)
+    print('Producing output images for {0} image files from {1} in {2} using {3} processes'.format(
+            len(imgFiles), source, outputDir, processes or os.cpu_count()))
+
+    start = time.perf_counter()
+    results = processImageFiles(imgFiles, outputDir, processes, maxInProgress)
+    elapsedSeconds = time.perf_counter() - start
+
+    failures = sum(1 for result in results if result['error'] != None)
+    renderSeconds = sum(result['seconds'] for result in results)
+    rate = len(results) / elapsedSeconds if elapsedSeconds > 0 else 0.0
+    print()
+    print('{0} images ({1} failed) processed in {2:.1f}s ({3:.1f}s of processing) : {4:.2f} images per second'.format(
+            len(results), failures, elapsedSeconds, renderSeconds, rate))
 
 # #####################################################################################################
 
 def main(argv) :
 
+    if len(argv) > 3 and argv[1] == '--batch' :
+        processes = int(argv[4]) if len(argv) > 4 else None
+        maxInProgress = int(argv[5]) if len(argv) > 5 else None
+        batchMain(argv[2], argv[3], processes, maxInProgress)
+        return
+
     if len(argv) > 1 and argv[1] != '-' :
         imgFile = argv[1]
     else :
@@ -452,13 +784,27 @@ def main(argv) :
         outputFileName = 'output.jpg'
         print('No output file provided, using default : ', outputFileName)
 
-    (labelsResponse, summaryText) = performLabelExtraction(imgFile)
+    # Optionally write the output as a PNG file in strips, and choose how to pack extracted images into rows.
+    stripHeight = int(argv[3]) if len(argv) > 3 and argv[3] != '-' else None
+    packing = argv[4] if len(argv) > 4 else 'greedy'
+    if packing not in rowPackings :
+        print()
+        print('*** Unknown row packing {0}, expected one of {1}'.format(packing, ', '.join(rowPackings)))
+        return
+    if stripHeight != None and not outputFileName.lower().endswith('.png') :
+        print()
+        print('*** Output file {0} must be a .png file to write it in strips'.format(outputFileName))
+        return
+
+    # Decode the image once, for use by all the processing below.
+    imageContext = rt1.ImageContext.fromFile(imgFile)
+    (labelsResponse, summaryText) = performLabelExtraction(imgFile, imageContext)
 
     print()
     print(summaryText)
     print()
 
-    produceOutputImage(imgFile, labelsResponse, summaryText, outputFileName)
+    produceOutputImage(imgFile, labelsResponse, summaryText, outputFileName, imageContext, stripHeight, packing)
 
 # #####################################################################################################
 
@@ -1,9 +1,44 @@
+# Translate a text file using Amazon Translate.
+#
+# https://docs.aws.amazon.com/translate/latest/dg/
+#
+# Translate limits the size of the text in each request, so longer documents are split into chunks on
+# paragraph boundaries (or sentence boundaries, or failing that word boundaries, for very long paragraphs),
+# with the chunks translated concurrently by a pool of threads, and the translations put back together in
+# the original order.
+#
+# Translated segments are kept in a translation memory (see the TranslationMemory module), so that when a
+# document changes, only the new or changed segments are sent to Translate.
+#
+# The text can be translated into several languages in one run, with the text read and split into segments
+# once, and the requests for all the languages sharing one pool of threads and one Translate client. When
+# there is more than one target language, each translation is written to a file alongside the text file,
+# e.g. language.fr.txt:
+#
+#   python Translate1.py <text file> <source language> <target language> [<target language> ...]
+#
+# A corpus of many small texts can also be translated, from a directory of text files or a JSON-lines file
+# of records with 'id' and 'text' fields, with the translations written to a JSON-lines output file:
+#
+#   python Translate1.py --corpus <directory or .jsonl file> <output .jsonl file> <source language> <target language>[,<target language> ...] [<number of threads>]
+#
+# Custom terminologies and formality can be requested in either mode, with extra arguments anywhere in the
+# command line:
+#
+#   --terminology <terminology name>[,<terminology name> ...]   --formality <FORMAL|INFORMAL>
+
 import sys
 import os
+import hashlib
+import json
+import re
+import threading
+import time
 
 import boto3
 
 import Cacher
+import TranslationMemory
 
 # Trial French text from Le Monde article 
 # https://www.lemonde.fr/international/article/2019/12/10/boris-johnson-parodie-une-scene-du-film-love-actually-et-agace-hugh-grant_6022351_3210.html
@@ -32,68 +67,505 @@ du Parti conservateur.
 '''
 ]
 
-def translate(textFile, fromLanguage='en', toLanguage='fr') :
-    # Check for a cached response file, using the image file name as the cache key. NB Will need
-    # something more sophisticated to allow different images in files of the same base name to be used.
-    textFileBasename = os.path.basename(textFile)
-    with open(textFile, 'r', encoding='utf-8') as f :
-        text = f.read()
+# #####################################################################################################
+
+# Splitting text into chunks small enough to translate.
+
+translateMaxChunkBytes = 5000       # Translate's limit on UTF-8 bytes per request (raised to 10,000 later)
+
+paragraphBreak = re.compile(r'(\n[ \t]*\n\s*)')        # One or more blank lines
+sentenceBreak = re.compile(r'((?<=[.!?…»"”])\s+)')    # White space after sentence-ending punctuation
+wordBreak = re.compile(r'(\s+)')
+
+def byteLength(text) :
+    return len(text.encode('utf-8'))
+
+def splitKeepingSeparators(text, separatorPattern) :
+    """ Split text using a regular expression (with a group around the separator), returning a list of
+        pieces which each include their trailing separator, so that joining them gives the original text """
+
+    parts = separatorPattern.split(text)
+    pieces = [ parts[i] + (parts[i+1] if i+1 < len(parts) else '') for i in range(0, len(parts), 2) ]
+    return [ piece for piece in pieces if piece != '' ]
+
+def splitIntoSegments(text, maxBytes=translateMaxChunkBytes) :
+    """ Split text into paragraphs, and any paragraphs over maxBytes into sentences, and any sentences still over
+        maxBytes into words (or as a last resort, characters). Joining the segments gives the original text. """
+
+    segments = []
+    for paragraph in splitKeepingSeparators(text, paragraphBreak) :
+        if byteLength(paragraph) <= maxBytes :
+            segments.append(paragraph)
+            continue
+        for sentence in splitKeepingSeparators(paragraph, sentenceBreak) :
+            if byteLength(sentence) <= maxBytes :
+                segments.append(sentence)
+                continue
+            for word in splitKeepingSeparators(sentence, wordBreak) :
+                while byteLength(word) > maxBytes :
+                    # Cut on a character boundary
+                    cut = len(word.encode('utf-8')[0:maxBytes].decode('utf-8', errors='ignore'))
+                    segments.append(word[0:cut])
+                    word = word[cut:]
+                segments.append(word)
+    return segments
+
+def packIntoBatches(segments, maxBytes=translateMaxChunkBytes, separator='\n\n') :
+    """ Group segments into batches which can be sent as one request, joined by the separator, of up to maxBytes.
+        Returns a list of lists of segments. """
+
+    batches = []
+    batch = []
+    batchBytes = 0
+    for segment in segments :
+        segmentBytes = byteLength(segment)
+        if len(batch) > 0 and batchBytes + byteLength(separator) + segmentBytes > maxBytes :
+            batches.append(batch)
+            batch = []
+            batchBytes = 0
+        batchBytes += segmentBytes if len(batch) == 0 else byteLength(separator) + segmentBytes
+        batch.append(segment)
+    if len(batch) > 0 :
+        batches.append(batch)
+    return batches
+
+# #####################################################################################################
+
+# A single Translate client is shared by all threads (boto3 clients are thread-safe), created when first needed,
+# with a connection pool large enough for the threads, and 'adaptive' retries to slow down if throttled.
+translateClient = None
+translateClientLock = threading.Lock()
+translateClientMaxConnections = 10
+
+def getTranslateClient() :
+    """ Return the shared Translate client, creating it if necessary """
+
+    global translateClient
+    with translateClientLock :
+        if translateClient == None :
+            from botocore.config import Config
+            config = Config(max_pool_connections=translateClientMaxConnections, retries={ 'mode' : 'adaptive', 'max_attempts' : 10 })
+            translateClient = boto3.client('translate', config=config)
+        return translateClient
+
+# Translation options are passed as a dictionary of extra translate_text arguments, e.g.
+#   { 'TerminologyNames' : ['myterms'], 'Settings' : { 'Formality' : 'FORMAL' } }
+# They affect the translation, so are included in cache keys and translation memory keys.
+
+def optionsKey(options) :
+    """ Return a canonical string form of the translation options, empty if there are none """
+    return json.dumps(options, sort_keys=True, separators=(',', ':')) if options else ''
+
+def translateText(text, fromLanguage, toLanguage, options=None) :
+    """ Translate a piece of text small enough for a single request, returning the translated text """
+
+    response = getTranslateClient().translate_text(Text=text, SourceLanguageCode=fromLanguage, TargetLanguageCode=toLanguage, **(options or {}))
+    return response['TranslatedText']
+
+def translateBatch(segments, fromLanguage, toLanguage, options=None) :
+    """ Translate a batch of segments in one request, as paragraphs, returning a list of their translations. If the
+        translation doesn't come back with the same number of paragraphs, translate the segments one by one. """
 
-    # Create a hash of the text to distinguish files with the same name but containing different text.
-    # Only use a few digits of it to keep filename short.
-    import hashlib
+    translated = translateText('\n\n'.join(segments), fromLanguage, toLanguage, options)
+    translations = [ paragraph.strip() for paragraph in splitKeepingSeparators(translated, paragraphBreak) ]
+    if len(translations) != len(segments) :
+        translations = [ translateText(segment, fromLanguage, toLanguage, options) for segment in segments ]
+    return translations
+
+class SourceDocument :
+    """ A text split into segments once, ready to be translated into any number of languages. Each segment is
+        translated without its surrounding white space (paragraph breaks etc), which is put back around the
+        translation when the translated document is assembled. """
+
+    def __init__(self, text, maxChunkBytes=translateMaxChunkBytes) :
+        self.text = text
+        self.maxChunkBytes = maxChunkBytes
+        self.segments = splitIntoSegments(text, maxChunkBytes)
+        self.cores = [ segment.strip() for segment in self.segments ]
+        # Each distinct segment only needs translating once.
+        self.uniqueCores = list(dict.fromkeys(core for core in self.cores if core != ''))
+
+    def assemble(self, translations) :
+        """ Return the translated document, given a dictionary of translations keyed on segment """
+
+        translatedSegments = []
+        for (segment, core) in zip(self.segments, self.cores) :
+            if core == '' :
+                translatedSegments.append(segment)
+            else :
+                leading = segment[0:len(segment) - len(segment.lstrip())]
+                trailing = segment[len(segment.rstrip()):]
+                translatedSegments.append(leading + translations[core] + trailing)
+        return ''.join(translatedSegments)
+
+def translateDocumentInto(document, fromLanguage, toLanguages, workers=4, memory=None, options=None) :
+    """ Translate a SourceDocument into each of the target languages, returning a dictionary of translated texts
+        keyed on language. Requests for all the languages are sent concurrently, using one pool of threads. If a
+        translation memory is specified, only segments not already in it are sent to Translate. """
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    global translateClientMaxConnections
+    translateClientMaxConnections = max(translateClientMaxConnections, workers)
+
+    # Work out what needs translating for each language.
+    translations = {}
+    batches = []        # (language, list of segments)
+    for toLanguage in toLanguages :
+        translations[toLanguage] = memory.lookup(document.uniqueCores, fromLanguage, toLanguage, optionsKey(options)) if memory != None else {}
+        missing = [ core for core in document.uniqueCores if core not in translations[toLanguage] ]
+        batches.extend((toLanguage, batch) for batch in packIntoBatches(missing, document.maxChunkBytes))
+
+    missingChars = sum(sum(len(segment) for segment in batch) for (_, batch) in batches)
+    print('Translating {0} characters into {1} languages using {2} threads ...'.format(missingChars, len(toLanguages), workers))
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor :
+        # map returns the results in the order of the batches, whatever order they complete in.
+        translatedBatches = list(executor.map(lambda item : translateBatch(item[1], fromLanguage, item[0], options), batches))
+    elapsedSeconds = time.perf_counter() - start
+
+    rate = missingChars / elapsedSeconds if elapsedSeconds > 0 else 0.0
+    print('... translated {0} characters in {1:.1f}s : {2:.0f} characters per second'.format(missingChars, elapsedSeconds, rate))
+
+    newTranslations = { toLanguage : {} for toLanguage in toLanguages }
+    for ((toLanguage, batch), translatedBatch) in zip(batches, translatedBatches) :
+        newTranslations[toLanguage].update(zip(batch, translatedBatch))
+    for toLanguage in toLanguages :
+        if memory != None :
+            memory.store(newTranslations[toLanguage], fromLanguage, toLanguage, optionsKey(options))
+        translations[toLanguage].update(newTranslations[toLanguage])
+
+    return { toLanguage : document.assemble(translations[toLanguage]) for toLanguage in toLanguages }
+
+def translateDocument(text, fromLanguage, toLanguage, workers=4, maxChunkBytes=translateMaxChunkBytes, memory=None, options=None) :
+    """ Translate text of any length, split into segments translated concurrently, returning the translated text """
+
+    return translateDocumentInto(SourceDocument(text, maxChunkBytes), fromLanguage, [toLanguage], workers, memory, options)[toLanguage]
+
+# #####################################################################################################
+
+# Whole-file translations are cached using a content-addressed key (see Cacher.contentItemID), from the full
+# SHA-256 digest of the file contents (calculated as the file is read), the languages and any options.
+#
+# Entries cached by earlier versions used "<file name>.<from>.<to>.<first 4 hex digits of digest>" as the key,
+# which could match an earlier revision of a file with the same name. These legacy entries are migrated to the
+# new key the first time they are found, and removed, so that no other revision of the file can pick them up.
+
+def legacyCacheID(textFile, text, fromLanguage, toLanguage) :
     textHashDigest = hashlib.sha256(text.encode()).hexdigest()
-    cacheID = "{0}.{1}.{2}.{3}".format(textFileBasename, fromLanguage, toLanguage, textHashDigest[0:4])
-    cacher = Cacher.Cacher('Translate', cacheID)
-    cachedResponse = cacher.findCachedResponse()
-    if cachedResponse == None :
-        print('Invoking Translate ...')
-        client = boto3.client('translate')
-        # Boto3 converts the raw Rekognition HTTP response to a Python data structure. 
-        response = client.translate_text(Text=text, SourceLanguageCode=fromLanguage, TargetLanguageCode=toLanguage)
-        print('... response received from Translate')
-        cacher.storeResponseInCache(response)
+    return "{0}.{1}.{2}.{3}".format(os.path.basename(textFile), fromLanguage, toLanguage, textHashDigest[0:4])
+
+def translateToLanguages(textFile, fromLanguage='en', toLanguages=['fr'], workers=4, memory=None, options=None) :
+    """ Translate a text file into each of the target languages, returning the text and a dictionary of responses
+        keyed on language. The file is read and split into segments once, however many languages there are. """
+
+    # Read the file, calculating its digest as it is read. Universal newlines, as for a file opened as text.
+    textBytes, textDigest = Cacher.readAndDigestFile(textFile)
+    text = textBytes.decode('utf-8').replace('\r\n', '\n').replace('\r', '\n')
+
+    cachers = {}
+    legacyCachers = {}      # Legacy entries were all made without options, so only looked for without options.
+    for toLanguage in toLanguages :
+        parameters = { 'SourceLanguageCode' : fromLanguage, 'TargetLanguageCode' : toLanguage, 'options' : options or {} }
+        cachers[toLanguage] = Cacher.Cacher.forContent('Translate', 'translate_text', textDigest, parameters)
+        if not options :
+            legacyCachers[toLanguage] = Cacher.Cacher('Translate', legacyCacheID(textFile, text, fromLanguage, toLanguage))
+
+    # Each language is fetched with getOrFetch, which holds the language's cache item lock while checking the
+    # cache again and fetching, so that if several processes are translating the same file at once, only one of
+    # them calls Translate. The first language that has to be translated is translated together with all the
+    # others which aren't cached yet, using one pool of threads, and their responses are cached straight away so
+    # that the later getOrFetch calls (here, or in another process waiting for the lock) find them. A language
+    # which another process is translating at the same moment may still be translated twice.
+    document = None
+    translatedTexts = {}
+    migratedLanguages = []
+
+    def makeResponse(toLanguage) :
+        # In the same form as a single translate_text call would produce.
+        return { 'TranslatedText' : translatedTexts[toLanguage], 'SourceLanguageCode' : fromLanguage, 'TargetLanguageCode' : toLanguage }
+
+    def fetch(toLanguage) :
+        nonlocal document
+        if toLanguage in legacyCachers :
+            response = legacyCachers[toLanguage].findCachedResponse(recordMiss=False)
+            if response != None :
+                migratedLanguages.append(toLanguage)
+                return response
+
+        if toLanguage not in translatedTexts :
+            otherLanguages = [ otherLanguage for otherLanguage in toLanguages
+                                if otherLanguage != toLanguage and otherLanguage not in responses and
+                                   not cachers[otherLanguage].isCached() and
+                                   not (otherLanguage in legacyCachers and legacyCachers[otherLanguage].isCached()) ]
+            if document == None :
+                document = SourceDocument(text)
+            translatedTexts.update(translateDocumentInto(document, fromLanguage, [toLanguage] + otherLanguages, workers, memory, options))
+            for otherLanguage in otherLanguages :
+                cachers[otherLanguage].storeResponseInCache(makeResponse(otherLanguage))
+        return makeResponse(toLanguage)
+
+    responses = {}
+    for toLanguage in toLanguages :
+        responses[toLanguage] = cachers[toLanguage].getOrFetch(lambda : fetch(toLanguage))
+        if toLanguage in migratedLanguages :
+            # Now stored under the new key, so the legacy entry can go.
+            legacyCacher = legacyCachers[toLanguage]
+            legacyCacher.removeEntries([legacyCacher.itemID], legacyCacher.getIndex())
+            print('Migrated cached {0} translation of {1} to new cache key'.format(toLanguage, textFile))
+
+    return text, responses
+
+def translate(textFile, fromLanguage='en', toLanguage='fr', workers=4, memory=None, options=None) :
+    """ Translate a text file into the target language, returning the text and the Translate response """
+
+    text, responses = translateToLanguages(textFile, fromLanguage, [toLanguage], workers, memory, options)
+    return text, responses[toLanguage]
+
+def outputFileNameFor(textFile, toLanguage) :
+    """ Return the name of the file to write the translation of a text file to, e.g. language.fr.txt """
+    (root, ext) = os.path.splitext(textFile)
+    return '{0}.{1}{2}'.format(root, toLanguage, ext)
+
+# #####################################################################################################
+
+# Corpus translation
+
+# The records in the corpus are read one at a time, translated by a pool of threads with a limited number of
+# records in progress, and the results written to the output file in the same order as the input, as soon
+# as they are available. So memory use doesn't depend on the size of the corpus. Because the output is in
+# input order, an interrupted run can be resumed by skipping as many input records as there are complete
+# lines in the output file. Segments already in the translation memory aren't sent to Translate again.
+#
+# A record which can't be read or translated (e.g. a file which isn't UTF-8, a JSON line with no 'text', or an
+# error from Translate) doesn't stop the run: an {"id": ..., "error": ...} line is written for it instead, so it
+# counts as done when resuming. Rerun just those records (to a new output file) to retry them.
+
+def readCorpusRecords(source) :
+    """ Generate (record ID, text, error) tuples from a directory of text files (in a fixed order, with the path
+        relative to the directory as the ID) or from a JSON-lines file of records with 'id' and 'text' fields. If a
+        record can't be read, its text is None and error is the exception, otherwise error is None. """
+
+    if os.path.isdir(source) :
+        for dirPath, dirNames, fileNames in os.walk(source) :
+            dirNames.sort()
+            for fileName in sorted(fileNames) :
+                filePath = os.path.join(dirPath, fileName)
+                recordID = os.path.relpath(filePath, source)
+                try :
+                    with open(filePath, 'r', encoding='utf-8') as f :
+                        text = f.read()
+                except (OSError, UnicodeDecodeError) as e :
+                    yield recordID, None, e
+                    continue
+                yield recordID, text, None
     else :
-        response = cachedResponse
+        # Read as bytes and decode each line separately, so that one bad line doesn't stop the rest being read.
+        with open(source, 'rb') as f :
+            for lineNumber, line in enumerate(f, start=1) :
+                if line.strip() == b'' :
+                    continue
+                recordID = lineNumber
+                try :
+                    record = json.loads(line.decode('utf-8'))
+                    recordID = record.get('id', lineNumber)
+                    text = record['text']
+                except KeyError :
+                    yield recordID, None, ValueError('Line {0} has no text field'.format(lineNumber))
+                    continue
+                except (ValueError, AttributeError) as e :
+                    yield recordID, None, ValueError('Line {0} is not a JSON record: {1}'.format(lineNumber, e))
+                    continue
+                if not isinstance(text, str) :
+                    yield recordID, None, ValueError('Line {0} text is not a string'.format(lineNumber))
+                    continue
+                yield recordID, text, None
+
+def countCompletedRecords(outputFileName) :
+    """ Return the number of complete records in an existing output file, removing any partly-written last line """
+
+    if not os.path.isfile(outputFileName) :
+        return 0
+    count = 0
+    completeBytes = 0
+    with open(outputFileName, 'rb') as f :
+        for line in f :
+            if not line.endswith(b'\n') :
+                break
+            count += 1
+            completeBytes += len(line)
+    if completeBytes < os.path.getsize(outputFileName) :
+        with open(outputFileName, 'r+b') as f :
+            f.truncate(completeBytes)
+    return count
+
+def translateRecord(text, fromLanguage, toLanguages, memory=None, options=None) :
+    """ Translate one text into the target languages, in the calling thread. Returns a dictionary of translated texts
+        keyed on language, and the number of characters sent to Translate. """
+
+    document = SourceDocument(text)
+    translatedTexts = {}
+    charsSent = 0
+    for toLanguage in toLanguages :
+        translations = memory.lookup(document.uniqueCores, fromLanguage, toLanguage, optionsKey(options)) if memory != None else {}
+        missing = [ core for core in document.uniqueCores if core not in translations ]
+        newTranslations = {}
+        for batch in packIntoBatches(missing, document.maxChunkBytes) :
+            newTranslations.update(zip(batch, translateBatch(batch, fromLanguage, toLanguage, options)))
+            charsSent += sum(len(segment) for segment in batch)
+        if memory != None :
+            memory.store(newTranslations, fromLanguage, toLanguage, optionsKey(options))
+        translations.update(newTranslations)
+        translatedTexts[toLanguage] = document.assemble(translations)
+    return translatedTexts, charsSent
+
+def translateCorpus(source, outputFileName, fromLanguage, toLanguages, workers=8, memory=None, options=None) :
+    """ Translate all the records from the source, appending the results to the output file as JSON lines, with an
+        error line for any record which fails. If the output file already has records in it, that many input records
+        are skipped, which assumes the input (the directory listing, or the JSON-lines file) hasn't changed since the
+        interrupted run. """
+
+    from collections import deque
+    from concurrent.futures import ThreadPoolExecutor, Future
+    import itertools
+
+    global translateClientMaxConnections
+    translateClientMaxConnections = max(translateClientMaxConnections, workers)
 
-    return text, response
+    skipCount = countCompletedRecords(outputFileName)
+    if skipCount > 0 :
+        print('Resuming after {0} records already in {1}'.format(skipCount, outputFileName))
+    records = itertools.islice(readCorpusRecords(source), skipCount, None)
+
+    maxInProgress = 2 * workers
+    counts = { 'records' : 0, 'chars' : 0, 'charsSent' : 0, 'failures' : 0 }
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor, open(outputFileName, 'a', encoding='utf-8') as output :
+
+        def writeResult(recordID, length, future) :
+            try :
+                translatedTexts, charsSent = future.result()
+                result = { 'id' : recordID, 'sourceLanguage' : fromLanguage, 'translations' : translatedTexts }
+                counts['records'] += 1
+                counts['chars'] += length
+                counts['charsSent'] += charsSent
+            except Exception as e :
+                print('*** Record {0} not translated: {1}'.format(recordID, e))
+                result = { 'id' : recordID, 'error' : str(e) }
+                counts['failures'] += 1
+            output.write(json.dumps(result, ensure_ascii=False) + '\n')
+            output.flush()
+
+        inProgress = deque()        # (record ID, text length, future), in input order
+        for recordID, text, error in records :
+            if error != None :
+                # Goes through the queue like any other record, to keep the output in input order.
+                future = Future()
+                future.set_exception(error)
+                inProgress.append((recordID, 0, future))
+            else :
+                inProgress.append((recordID, len(text), executor.submit(translateRecord, text, fromLanguage, toLanguages, memory, options)))
+            # Write out the oldest records once they're done, or wait for the oldest if too many are in progress.
+            while len(inProgress) > 0 and (inProgress[0][2].done() or len(inProgress) >= maxInProgress) :
+                writeResult(*inProgress.popleft())
+        while len(inProgress) > 0 :
+            writeResult(*inProgress.popleft())
+    elapsedSeconds = time.perf_counter() - start
+
+    rate = counts['chars'] / elapsedSeconds if elapsedSeconds > 0 else 0.0
+    print('{0} records ({1} characters, {2} sent to Translate) translated into {3} in {4:.1f}s using {5} threads : {6:.0f} characters per second'.format(
+            counts['records'], counts['chars'], counts['charsSent'], ', '.join(toLanguages), elapsedSeconds, workers, rate))
+    if counts['failures'] > 0 :
+        print('*** {0} records not translated - see the error lines in {1}'.format(counts['failures'], outputFileName))
 
 # #####################################################################################################
 
+def corpusMain(source, outputFileName, sourceLang, targetLangs, workers, options=None) :
+
+    if not os.path.exists(source) :
+        print()
+        print('*** Directory or JSON-lines file {0} not found'.format(source))
+        return
+
+    memory = TranslationMemory.TranslationMemory.fromEnvironment()
+    translateCorpus(source, outputFileName, sourceLang, targetLangs, workers, memory, options)
+    print(memory.summary())
+
+def parseOptions(argv) :
+    """ Remove any '--terminology <names>' and '--formality <FORMAL|INFORMAL>' arguments from the argument list,
+        returning the remaining arguments and the translation options dictionary. """
+
+    options = {}
+    remaining = []
+    i = 0
+    while i < len(argv) :
+        if argv[i] == '--terminology' and i+1 < len(argv) :
+            options['TerminologyNames'] = [ name for name in argv[i+1].split(',') if name != '' ]
+            i += 2
+        elif argv[i] == '--formality' and i+1 < len(argv) :
+            options['Settings'] = { 'Formality' : argv[i+1].upper() }
+            i += 2
+        else :
+            remaining.append(argv[i])
+            i += 1
+    return remaining, options
+
 def main(argv) :
 
+    argv, options = parseOptions(argv)
+
+    if len(argv) > 5 and argv[1] == '--corpus' :
+        targetLangs = [ lang for lang in argv[5].split(',') if lang != '' ]
+        workers = int(argv[6]) if len(argv) > 6 else 8
+        corpusMain(argv[2], argv[3], argv[4], targetLangs, workers, options)
+        return
+
     if len(argv) > 1 and argv[1] != '-' :
         textFile = argv[1]
     else :
         textFile = 'AI Services/language.txt'
         print('No text file argument provided, using default : ', textFile)
 
+    # More than one target language can be given, either as separate arguments, or comma-separated.
     if len(argv) > 3 :
         sourceLang = argv[2]
-        targetLang = argv[3]
+        targetLangs = [ lang for arg in argv[3:] for lang in arg.split(',') if lang != '' ]
     else :
         sourceLang = 'en'
-        targetLang = 'fr'
+        targetLangs = ['fr']
 
     if not os.path.isfile(textFile) :
         print()
         print('*** File {0} not found'.format(textFile))
         return
 
-    text, response = translate(textFile, fromLanguage=sourceLang, toLanguage=targetLang)
+    memory = TranslationMemory.TranslationMemory.fromEnvironment()
+    text, responses = translateToLanguages(textFile, fromLanguage=sourceLang, toLanguages=targetLangs, memory=memory, options=options)
 
     bar = "=================================================================================="
-    print('Converted:')
-    print()
-    print(bar)
-    print(text)    
-    print(bar)
-    print()
-    print('to:')
+    if len(targetLangs) == 1 :
+        print('Converted:')
+        print()
+        print(bar)
+        print(text)    
+        print(bar)
+        print()
+        print('to:')
+        print()
+        print(bar)
+        print(responses[targetLangs[0]]['TranslatedText'])    
+        print(bar)
+    else :
+        # Write each translation to its own file alongside the source file.
+        for targetLang in targetLangs :
+            outputFileName = outputFileNameFor(textFile, targetLang)
+            with open(outputFileName, 'w', encoding='utf-8') as f :
+                f.write(responses[targetLang]['TranslatedText'])
+            print('Translation into {0} written to {1}'.format(targetLang, outputFileName))
+
     print()
-    print(bar)
-    print(response['TranslatedText'])    
-    print(bar)
+    print(memory.summary())
 
 if __name__ == '__main__' :    
     main(sys.argv)
\ No newline at end of file
@@ -0,0 +1,125 @@
+# A 'translation memory': a store of previously translated text segments (paragraphs or sentences), so that
+# when a document is translated again after some editing, only the new or changed segments need to be sent
+# to Amazon Translate, with the rest of the translation stitched together from the stored segments.
+#
+# Segments are keyed on a SHA-256 digest of the normalised segment text (Unicode NFC form, with runs of
+# white space reduced to a single space), plus the source and target language codes. Only the digest of the
+# source text is stored, not the text itself, keeping the key small. Translations made with different
+# options (e.g. custom terminology or formality) are kept apart by including a 'variant' string describing
+# the options in the digest.
+#
+# The store is a single SQLite database file, by default translation-memory.sqlite in the Translate response
+# cache location (see Cacher), or as named by the TRANSLATION_MEMORY_FILE environment variable. SQLite's
+# B-tree index on the (language pair, digest) key keeps lookups quick with millions of segments, and lookups
+# and stores are done a batch of segments at a time, within a single transaction for stores.
+
+import sys
+import os
+import hashlib
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+import Cacher
+
+# #####################################################################################################
+
+whiteSpace = re.compile(r'\s+')
+
+def normaliseSegment(segment) :
+    """ Return the normalised form of a segment of text, used to match segments """
+    return whiteSpace.sub(' ', unicodedata.normalize('NFC', segment)).strip()
+
+def segmentKey(segment, variant='') :
+    h = hashlib.sha256(normaliseSegment(segment).encode('utf-8'))
+    if variant != '' :
+        h.update(b'\0' + variant.encode('utf-8'))
+    return h.digest()
+
+class TranslationMemory :
+    """ Store of translated segments, held in an SQLite database """
+
+    envVarName = 'TRANSLATION_MEMORY_FILE'
+    dbFileName = 'translation-memory.sqlite'
+    queryBatchSize = 500        # Number of segments to look up per query (SQLite limits the number of parameters)
+
+    def __init__(self, dbFile) :
+        self.dbFile = dbFile
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+        dbDir = os.path.dirname(dbFile)
+        if dbDir != '' :
+            os.makedirs(dbDir, exist_ok=True)
+        self.conn = sqlite3.connect(dbFile, timeout=30, check_same_thread=False)
+        with self.conn :
+            # WAL journalling lets other processes read while one is writing.
+            self.conn.execute('PRAGMA journal_mode=WAL')
+            self.conn.execute('''CREATE TABLE IF NOT EXISTS segments (
+                                    sourceLanguage TEXT, targetLanguage TEXT, segmentKey BLOB, translation TEXT, created REAL,
+                                    PRIMARY KEY (sourceLanguage, targetLanguage, segmentKey)) WITHOUT ROWID''')
+
+    @classmethod
+    def fromEnvironment(cls) :
+        """ Return the translation memory named by the environment variable, or the one in the Translate cache location """
+        dbFile = os.environ.get(cls.envVarName)
+        if dbFile == None :
+            dbFile = os.path.join(Cacher.Cacher('Translate', '-').cacheLocation, cls.dbFileName)
+        return cls(dbFile)
+
+    def lookup(self, segments, sourceLanguage, targetLanguage, variant='') :
+        """ Return a dictionary of the translations found for the segments, keyed on segment """
+
+        keys = { segment : segmentKey(segment, variant) for segment in segments }
+        uniqueKeys = list(set(keys.values()))
+        found = {}
+        with self.lock :
+            for i in range(0, len(uniqueKeys), self.queryBatchSize) :
+                batch = uniqueKeys[i:i+self.queryBatchSize]
+                query = 'SELECT segmentKey, translation FROM segments WHERE sourceLanguage = ? AND targetLanguage = ? AND segmentKey IN ({0})'.format(
+                            ','.join('?' * len(batch)))
+                for (key, translation) in self.conn.execute(query, [sourceLanguage, targetLanguage] + batch) :
+                    found[bytes(key)] = translation
+
+            # Lookups and stores can come from many threads, so the counters are only updated with the lock held.
+            translations = { segment : found[key] for (segment, key) in keys.items() if key in found }
+            self.hits += len(translations)
+            self.misses += len(keys) - len(translations)
+        return translations
+
+    def store(self, translations, sourceLanguage, targetLanguage, variant='') :
+        """ Store a dictionary of translations, keyed on segment """
+
+        now = time.time()
+        rows = [ (sourceLanguage, targetLanguage, segmentKey(segment, variant), translation, now) for (segment, translation) in translations.items() ]
+        with self.lock, self.conn :
+            self.conn.executemany('INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?)', rows)
+            self.stores += len(rows)
+
+    def size(self) :
+        with self.lock :
+            return self.conn.execute('SELECT count(*) FROM segments').fetchone()[0]
+
+    def summary(self) :
+        with self.lock :
+            hits, misses, stores = self.hits, self.misses, self.stores
+        lookups = hits + misses
+        hitRate = 100 * hits / lookups if lookups > 0 else 0.0
+        return 'Translation memory: {0} of {1} segments found, hit rate {2:.1f}% ; {3} segments stored'.format(
+                hits, lookups, hitRate, stores)
+
+# #####################################################################################################
+
+def main(argv) :
+
+    memory = TranslationMemory(argv[1]) if len(argv) > 1 else TranslationMemory.fromEnvironment()
+    print('Translation memory {0} holds {1} segments'.format(memory.dbFile, memory.size()))
+
+# #####################################################################################################
+
+if __name__ == '__main__' :
+    main(sys.argv)